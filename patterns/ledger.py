@@ -1,71 +1,1282 @@
 # Import Built-ins
-from itertools import islice    
+import logging
+import mmap
+import multiprocessing as mp
+import os
+import struct
+import threading
+import time
+import zlib
+from bisect import bisect_left, bisect_right, insort
+from decimal import Decimal, ROUND_HALF_EVEN
 
 # Import Homebrew libs
 
+# Init Logging Facilities
+log = logging.getLogger(__name__)
+
+
+def to_ticks(price, tick_size):
+    """Convert a price to an integer number of ticks.
+
+    Floats and ints are divided directly and rounded to the nearest tick,
+    while strings and Decimals are converted exactly via Decimal.
+
+    :param price: str, float, int or Decimal price
+    :param tick_size: str, float, int or Decimal tick size
+    :return: int
+    """
+    if isinstance(price, (int, float)) and isinstance(tick_size, (int, float)):
+        return int(round(price / tick_size))
+    ticks = Decimal(str(price)) / Decimal(str(tick_size))
+    return int(ticks.to_integral_value(rounding=ROUND_HALF_EVEN))
+
+
+def from_ticks(ticks, tick_size):
+    """Convert an integer number of ticks back to an exact Decimal price.
+
+    :param ticks: int
+    :param tick_size: str, float, int or Decimal tick size
+    :return: Decimal
+    """
+    return ticks * Decimal(str(tick_size))
+
 
 class Quote:
-    def __init__(self, price, size, side):
+    __slots__ = ('price', 'size', 'side', 'order_id')
+
+    def __init__(self, price, size, side, order_id=None):
         self.price = price
         self.size = size
         self.side = side
+        self.order_id = order_id
+
+
+class Level:
+    """Price level of a level 3 book.
+
+    Holds the individual orders at one price in a dict keyed by order id,
+    which preserves arrival (FIFO) order and allows O(1) removal; size is
+    the running total of all orders on the level.
+    """
+    __slots__ = ('price', 'size', 'side', 'orders')
+
+    def __init__(self, price, side):
+        self.price = price
+        self.size = 0
+        self.side = side
+        self.orders = {}
+
+    def __len__(self):
+        return len(self.orders)
+
+    def __iter__(self):
+        return iter(self.orders.values())
+
+
+_REINDEX_THRESHOLD = 64
+#: Free tick slots kept on either side of the levels of a tick indexed side.
+_TICK_SLACK = 64
+#: Widest range of ticks a side indexes by tick, beyond this it falls back
+#: to indexing buckets of levels.
+_MAX_TICK_SPAN = 1 << 18
+#: Levels per bucket of a side indexing buckets; a bucket grown to twice as
+#: many is split.
+_BUCKET_SIZE = 64
+_NAN = float('nan')
+
+
+def _as_list(values):
+    # NumPy arrays convert to native Python scalars far quicker in one
+    # tolist() call than by iterating over them element by element.
+    tolist = getattr(values, 'tolist', None)
+    return tolist() if tolist is not None else list(values)
+
+
+def _is_bid(side):
+    if isinstance(side, str):
+        return side == 'bid'
+    return bool(side)
+
+
+class _Fenwick:
+    """Binary indexed tree over a list of numbers.
+
+    Supports point updates, prefix sums and finding the first position at
+    which the running total reaches a target, each in O(log n).
+    """
+    __slots__ = ('_tree',)
+
+    def __init__(self, values):
+        tree = [0]
+        tree.extend(values)
+        n = len(tree)
+        for i in range(1, n):
+            j = i + (i & -i)
+            if j < n:
+                tree[j] += tree[i]
+        self._tree = tree
+
+    def add(self, index, delta):
+        tree = self._tree
+        i = index + 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def prefix(self, count):
+        """Return the sum of the first count values."""
+        tree = self._tree
+        total = 0
+        while count > 0:
+            total += tree[count]
+            count -= count & -count
+        return total
+
+    def search(self, target):
+        """Return the number of leading values whose sum stays below target.
+
+        This equals the index of the value at which the running total first
+        reaches target, or the number of values if it never does.
+        """
+        tree = self._tree
+        pos, step = 0, 1 << (len(tree) - 1).bit_length()
+        while step:
+            nxt = pos + step
+            if nxt < len(tree) and tree[nxt] < target:
+                pos = nxt
+                target -= tree[nxt]
+            step >>= 1
+        return pos
+
+    def values(self):
+        """Return the list of numbers the tree sums over."""
+        values = self._tree[:]
+        n = len(values)
+        for i in range(n - 1, 0, -1):
+            j = i + (i & -i)
+            if j < n:
+                values[j] -= values[i]
+        return values[1:]
 
 
 class Side:
-    def __init__(self, reverse=False):
+    """Price levels of one side of the book, kept in priority order.
+
+    Levels are stored in a dict keyed by their sort key, while a parallel list
+    of sort keys is kept sorted via bisect; the best level is always at index
+    0, inserts and removals cost a binary search plus a list shift, and reads
+    never need to sort.
+
+    If a tick_size is given, prices are keyed by their integer tick count
+    instead of float(price), making comparisons exact integer operations.
+
+    Cumulative size and notional per level are served from Fenwick trees.
+    With a tick_size, the trees hold one slot per tick over the range of
+    prices in the book plus some slack, so adding, removing and resizing a
+    level are all O(log n) point updates; a level outside that range makes
+    the trees regrow, in O(range), on the next aggregate query. Without a
+    tick_size, or once the prices span more than _MAX_TICK_SPAN ticks, the
+    trees hold one slot per bucket of about _BUCKET_SIZE consecutive levels
+    instead, bounded by the keys in _bounds. Levels map to buckets by their
+    key rather than their position, so adding, removing and resizing them
+    stay O(log n) point updates, while queries add up the levels of one
+    bucket on top of the tree's prefix. Buckets grown to twice the size are
+    split on the next query, rebuilding the trees over the buckets only.
+    """
+    side = None
+
+    def __init__(self, reverse=False, tick_size=None):
         self._orders = {}
+        self._keys = []
         self._reverse = reverse
+        self._depth = None
+        self._base = None
+        self._span = 0
+        self._bounds = None
+        self._counts = None
+        self._crowded = False
+        self.tick_size = tick_size
+        self._key_scale = 1.0 if tick_size is None else float(tick_size)
+        if tick_size is None:
+            to_key = float
+        else:
+            def to_key(price):
+                return to_ticks(price, tick_size)
+        if reverse:
+            self._sort_key = lambda price: -to_key(price)
+        else:
+            self._sort_key = to_key
 
     def add(self, order):
-        self._orders[order.price] = order
+        key = self._sort_key(order.price)
+        previous = self._orders.get(key)
+        if previous is None:
+            insort(self._keys, key)
+            self._level_added(key, order.size)
+        else:
+            self._resize(key, order.size - previous.size)
+        self._orders[key] = order
         return True
 
     def remove(self, order):
+        key = self._sort_key(order.price)
         try:
-            self._orders.pop(order.price)
-            return True
+            previous = self._orders.pop(key)
         except KeyError:
             return False
+        del self._keys[bisect_left(self._keys, key)]
+        self._level_removed(key, previous.size)
+        return True
+
+    def add_order(self, order):
+        """Queue an individual order at the back of its price level.
+
+        :param order: Quote with an order_id
+        :return:
+        """
+        key = self._sort_key(order.price)
+        level = self._orders.get(key)
+        if level is None:
+            level = self._orders[key] = Level(order.price, self.side)
+            insort(self._keys, key)
+            self._level_added(key, order.size)
+        else:
+            self._resize(key, order.size)
+        level.orders[order.order_id] = order
+        level.size += order.size
+
+    def remove_order(self, order):
+        """Remove an individual order, dropping its level once it is empty.
+
+        :param order: Quote previously passed to add_order()
+        :return:
+        """
+        key = self._sort_key(order.price)
+        level = self._orders[key]
+        del level.orders[order.order_id]
+        if not level.orders:
+            del self._orders[key]
+            del self._keys[bisect_left(self._keys, key)]
+            self._level_removed(key, level.size)
+            return
+        level.size -= order.size
+        self._resize(key, -order.size)
+
+    def replace_order(self, order):
+        """Swap in a smaller version of a queued order, keeping its place.
+
+        :param order: Quote with the id and price of a queued order
+        :return:
+        """
+        key = self._sort_key(order.price)
+        level = self._orders[key]
+        delta = order.size - level.orders[order.order_id].size
+        level.orders[order.order_id] = order
+        level.size += delta
+        self._resize(key, delta)
+
+    def update_many(self, prices, sizes):
+        """Apply a batch of level updates, removing levels of size 0.
+
+        New and removed keys are collected and merged into the key index in
+        one go, rather than bisecting once per level.
+
+        :param prices: sequence of prices
+        :param sizes: sequence of sizes, matching prices
+        :return:
+        """
+        orders = self._orders
+        sort_key = self._sort_key
+        added, removed, deltas = [], [], []
+        for price, size in zip(prices, sizes):
+            key = sort_key(price)
+            if size:
+                previous = orders.get(key)
+                if previous is None:
+                    added.append(key)
+                    deltas.append((key, size))
+                else:
+                    deltas.append((key, size - previous.size))
+                orders[key] = Quote(price, size, self.side)
+            else:
+                previous = orders.pop(key, None)
+                if previous is not None:
+                    removed.append(key)
+                    deltas.append((key, -previous.size))
+        if added or removed:
+            self._reindex(added, removed)
+            for key in added:
+                self._recount(key, 1)
+            for key in removed:
+                self._recount(key, -1)
+        for key, delta in deltas:
+            self._resize(key, delta)
+
+    def load(self, prices, sizes):
+        """Replace all levels of this side with the given ones.
+
+        :param prices: sequence of prices
+        :param sizes: sequence of sizes, matching prices
+        :return:
+        """
+        sort_key = self._sort_key
+        self._orders = {sort_key(price): Quote(price, size, self.side)
+                        for price, size in zip(prices, sizes) if size}
+        self._keys = sorted(self._orders)
+        self._depth = None
+
+    def _reindex(self, added, removed):
+        if len(added) + len(removed) > _REINDEX_THRESHOLD:
+            # A single timsort pass over the mostly sorted keys beats
+            # shifting the list once per changed level.
+            self._keys = sorted(self._orders)
+            return
+        # A key may be added and removed several times within one batch, so
+        # the final state is read from self._orders rather than the lists.
+        keys = self._keys
+        for key in removed:
+            if key not in self._orders:
+                i = bisect_left(keys, key)
+                if i < len(keys) and keys[i] == key:
+                    del keys[i]
+        for key in added:
+            if key in self._orders:
+                i = bisect_left(keys, key)
+                if i == len(keys) or keys[i] != key:
+                    keys.insert(i, key)
+
+    def _price_of(self, key):
+        return abs(key) * self._key_scale
+
+    def _level_added(self, key, size):
+        self._recount(key, 1)
+        self._resize(key, size)
+
+    def _level_removed(self, key, size):
+        self._recount(key, -1)
+        self._resize(key, -size)
+
+    def _recount(self, key, delta):
+        # Only buckets keep count of their levels, to know when to split.
+        if self._depth is None or self._base is not None:
+            return
+        bucket = self._bucket(key)
+        self._counts[bucket] += delta
+        if self._counts[bucket] > 2 * _BUCKET_SIZE:
+            self._crowded = True
+
+    def _resize(self, key, delta):
+        if self._depth is None:
+            return
+        if self._base is None:
+            i = self._bucket(key)
+        else:
+            i = key - self._base
+            if not 0 <= i < self._span:
+                # Regrow the tick range on the next aggregate query.
+                self._depth = None
+                return
+        sizes, notional = self._depth
+        sizes.add(i, delta)
+        notional.add(i, delta * self._price_of(key))
+
+    def _aggregates(self):
+        if self._depth is None:
+            keys, orders = self._keys, self._orders
+            if (self.tick_size is not None and keys and
+                    2 * (keys[-1] - keys[0] + _TICK_SLACK) < _MAX_TICK_SPAN):
+                slack = (keys[-1] - keys[0]) // 2 + _TICK_SLACK
+                self._base = keys[0] - slack
+                self._span = keys[-1] - keys[0] + 1 + 2 * slack
+                sizes, notional = [0] * self._span, [0.0] * self._span
+                for key in keys:
+                    size = orders[key].size
+                    sizes[key - self._base] = size
+                    notional[key - self._base] = size * self._price_of(key)
+            else:
+                self._base = None
+                buckets = [keys[i:i + _BUCKET_SIZE]
+                           for i in range(0, len(keys), _BUCKET_SIZE)] or [[]]
+                # The first bucket also takes any key below the others.
+                self._bounds = [bucket[0] if bucket else None
+                                for bucket in buckets]
+                self._counts = [len(bucket) for bucket in buckets]
+                sizes, notional = zip(*map(self._totals, buckets))
+            self._crowded = False
+            self._depth = _Fenwick(sizes), _Fenwick(notional)
+        elif self._crowded:
+            self._split()
+        return self._depth
+
+    def _totals(self, keys):
+        """Return the total size and notional of the levels of keys."""
+        orders, price_of = self._orders, self._price_of
+        size, notional = 0, 0.0
+        for key in keys:
+            level_size = orders[key].size
+            size += level_size
+            notional += level_size * price_of(key)
+        return size, notional
+
+    def _split(self):
+        """Split the buckets grown to over twice _BUCKET_SIZE levels."""
+        self._crowded = False
+        if len(self._counts) > 2 * (len(self._keys) // _BUCKET_SIZE + 1):
+            # Mostly buckets emptied as prices moved on, so start over.
+            self._depth = None
+            self._aggregates()
+            return
+        sizes, notional = (tree.values() for tree in self._depth)
+        for bucket in reversed(range(len(self._counts))):
+            if self._counts[bucket] <= 2 * _BUCKET_SIZE:
+                continue
+            start, stop = self._bucket_span(bucket)
+            keys = self._keys[start:stop]
+            pieces = [keys[i:i + _BUCKET_SIZE]
+                      for i in range(0, len(keys), _BUCKET_SIZE)]
+            self._bounds[bucket + 1:bucket + 1] = [
+                piece[0] for piece in pieces[1:]]
+            self._counts[bucket:bucket + 1] = [len(piece) for piece in pieces]
+            totals = [self._totals(piece) for piece in pieces]
+            sizes[bucket:bucket + 1] = [size for size, _ in totals]
+            notional[bucket:bucket + 1] = [value for _, value in totals]
+        self._depth = _Fenwick(sizes), _Fenwick(notional)
+
+    def _bucket(self, key):
+        """Return the bucket holding key."""
+        return bisect_right(self._bounds, key, 1) - 1
+
+    def _bucket_span(self, bucket):
+        """Return the start and stop positions of the levels of bucket."""
+        keys, bounds = self._keys, self._bounds
+        start = bisect_left(keys, bounds[bucket]) if bucket else 0
+        if bucket + 1 < len(bounds):
+            return start, bisect_left(keys, bounds[bucket + 1])
+        return start, len(keys)
+
+    def _size_of(self, count):
+        """Return the total size of the first count levels."""
+        sizes, _ = self._aggregates()
+        if not count:
+            return 0
+        key = self._keys[count - 1]
+        if self._base is not None:
+            return sizes.prefix(key - self._base + 1)
+        bucket = self._bucket(key)
+        start, _ = self._bucket_span(bucket)
+        orders = self._orders
+        return sizes.prefix(bucket) + sum(
+            orders[key].size for key in self._keys[start:count])
+
+    def best_price(self):
+        """Return the best price of this side as a float.
+
+        :return: float
+        """
+        return self._price_of(self._keys[0])
+
+    def cumulative_size(self, level):
+        """Return the total size of the levels 0 to level, inclusive.
+
+        :param level: int, index of the deepest level to include
+        :return:
+        """
+        return self._size_of(min(level + 1, len(self._keys)))
+
+    def size_within(self, limit):
+        """Return the total size of all levels priced at or better than limit.
+
+        :param limit: numeric price
+        :return:
+        """
+        limit_key = limit / self._key_scale
+        if self._reverse:
+            limit_key = -limit_key
+        return self._size_of(bisect_right(self._keys, limit_key))
+
+    def vwap_for_size(self, qty):
+        """Return the average price paid to fill qty against this side.
+
+        :param qty: size to fill, must be positive
+        :return: float
+        :raises ValueError: if the side holds less than qty in total
+        """
+        if qty <= 0:
+            raise ValueError('qty must be positive')
+        sizes, notional = self._aggregates()
+        i = sizes.search(qty)
+        filled, cost = sizes.prefix(i), notional.prefix(i)
+        if self._base is not None:
+            if i < self._span:
+                key = self._base + i
+                return (cost + (qty - filled) * self._price_of(key)) / qty
+        elif i < len(self._counts):
+            # The running total reaches qty within bucket i.
+            keys, orders = self._keys, self._orders
+            for position in range(self._bucket_span(i)[0], len(keys)):
+                key = keys[position]
+                size = orders[key].size
+                if filled + size >= qty:
+                    return (cost + (qty - filled) * self._price_of(key)) / qty
+                filled += size
+                cost += size * self._price_of(key)
+        raise ValueError('Insufficient depth to fill %r' % qty)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return (self._orders[key] for key in self._keys)
 
     def __getitem__(self, key):
-        keys = sorted(self._orders.keys(), reverse=self._reverse,
-                      key=lambda x: float(x))
         if isinstance(key, int):
-            key, = islice(keys, key, key + 1)
-            return self._orders[key]
+            return self._orders[self._keys[key]]
         elif not isinstance(key, slice):
             raise TypeError()
-        return [self._orders[key] for
-                key in islice(keys, key.start, key.stop, key.step)]
+        return [self._orders[k] for k in self._keys[key]]
 
 
 class Bids(Side):
-    def __init__(self):
-        super(Bids, self).__init__(reverse=True)
+    side = 'bid'
+
+    def __init__(self, tick_size=None):
+        super(Bids, self).__init__(reverse=True, tick_size=tick_size)
 
 
 class Asks(Side):
-    def __init__(self):
-        super(Asks, self).__init__(reverse=False)
+    side = 'ask'
+
+    def __init__(self, tick_size=None):
+        super(Asks, self).__init__(reverse=False, tick_size=tick_size)
 
 
 class Ledger:
-    def __init__(self):
-        self.asks = Asks()
-        self.bids = Bids()
+    """Order book made up of Bids and Asks.
+
+    By default the book is level 2: one Quote per price, where adding a Quote
+    replaces the level at its price. With level3=True, Quotes are individual
+    orders identified by their order_id; they queue up FIFO per price, the
+    sides hold Level objects, and orders are cancelled or modified by id.
+
+    Callbacks registered via subscribe() are told about changes to the top of
+    the book; as they receive plain tuples, a pubsub Publisher's publish()
+    may be subscribed directly to fan them out.
+
+    If a LedgerJournal is given, every change applied to the book is appended
+    to it, so the book can be rebuilt later via LedgerReplay.
+    """
+    def __init__(self, tick_size=None, level3=False, journal=None):
+        """Initialize instance.
+
+        :param tick_size: if given, prices are indexed as integer multiples
+            of it (see to_ticks()) rather than as floats
+        :param level3: track individual orders instead of price levels
+        :param journal: LedgerJournal to record changes to
+        """
+        self.tick_size = tick_size
+        self.level3 = level3
+        self.journal = journal
+        self.asks = Asks(tick_size)
+        self.bids = Bids(tick_size)
+        self._order_index = {}
+        self._subscriptions = []
 
     def add(self, order):
+        if self.level3 and order.order_id in self._order_index:
+            raise KeyError('Duplicate order id %r' % order.order_id)
+        if self.journal is not None:
+            self.journal.record(OP_ADD, order.side, order.price, order.size,
+                                order.order_id)
         side = self.bids if order.side == 'bid' else self.asks
-        side.add(order)
+        if self.level3:
+            side.add_order(order)
+            self._order_index[order.order_id] = order
+        else:
+            side.add(order)
+        if self._subscriptions:
+            self._notify()
 
     def update(self, order):
+        if self.level3:
+            if order.size == 0:
+                self.cancel(order.order_id)
+            elif order.order_id in self._order_index:
+                self.modify(order.order_id, order.size, order.price)
+            else:
+                self.add(order)
+            return
+        if self.journal is not None:
+            self.journal.record(OP_UPDATE, order.side, order.price,
+                                order.size)
         side = self.asks if order.side == 'ask' else self.bids
         if order.size == 0:
             side.remove(order)
         else:
             side.add(order)
+        if self._subscriptions:
+            self._notify()
+
+    def get_order(self, order_id):
+        return self._order_index[order_id]
+
+    def cancel(self, order_id):
+        """Remove an order from a level 3 book.
+
+        :param order_id: id of the order to cancel
+        :return: True if the order was found, else False
+        """
+        order = self._order_index.pop(order_id, None)
+        if order is None:
+            return False
+        if self.journal is not None:
+            self.journal.record(OP_CANCEL, order.side, order.price, 0,
+                                order_id)
+        side = self.bids if order.side == 'bid' else self.asks
+        side.remove_order(order)
+        if self._subscriptions:
+            self._notify()
+        return True
+
+    def modify(self, order_id, size=None, price=None):
+        """Change the size and/or price of an order in a level 3 book.
+
+        Reducing the size keeps the order's place in the queue; a price
+        change or size increase moves it to the back of its (new) level, and
+        a size of 0 cancels it.
+
+        :param order_id: id of the order to modify
+        :param size: new size, defaults to the current size
+        :param price: new price, defaults to the current price
+        :return:
+        """
+        if size == 0:
+            self.cancel(order_id)
+            return
+        order = self._order_index[order_id]
+        size = order.size if size is None else size
+        price = order.price if price is None else price
+        if self.journal is not None:
+            self.journal.record(OP_MODIFY, order.side, price, size, order_id)
+        side = self.bids if order.side == 'bid' else self.asks
+        new = Quote(price, size, order.side, order_id)
+        if (side._sort_key(price) == side._sort_key(order.price) and
+                size <= order.size):
+            side.replace_order(new)
+        else:
+            side.remove_order(order)
+            side.add_order(new)
+        self._order_index[order_id] = new
+        if self._subscriptions:
+            self._notify()
+
+    def apply_batch(self, prices, sizes, sides):
+        """Apply a batch of level updates in one pass.
+
+        Accepts any sequences, including NumPy arrays and array.array; levels
+        with a size of 0 are removed.
+
+        :param prices: sequence of prices
+        :param sizes: sequence of sizes
+        :param sides: sequence of 'bid'/'ask', or of flags where truthy
+            values denote bids
+        :return:
+        :raises TypeError: on a level 3 book
+        """
+        if self.level3:
+            raise TypeError('apply_batch() requires a level 2 book')
+        bids, asks = ([], []), ([], [])
+        for price, size, side in zip(_as_list(prices), _as_list(sizes),
+                                     _as_list(sides)):
+            prices_, sizes_ = bids if _is_bid(side) else asks
+            prices_.append(price)
+            sizes_.append(size)
+        if self.journal is not None:
+            self.journal.record_many(OP_UPDATE, 'bid', *bids)
+            self.journal.record_many(OP_UPDATE, 'ask', *asks)
+        self.bids.update_many(*bids)
+        self.asks.update_many(*asks)
+        if self._subscriptions:
+            self._notify()
+
+    def load_snapshot(self, prices, sizes, side):
+        """Rebuild one side of the book from a full snapshot.
+
+        :param prices: sequence of prices
+        :param sizes: sequence of sizes
+        :param side: 'bid' or 'ask'
+        :return:
+        :raises TypeError: on a level 3 book
+        """
+        if self.level3:
+            raise TypeError('load_snapshot() requires a level 2 book')
+        side = self.bids if _is_bid(side) else self.asks
+        prices, sizes = _as_list(prices), _as_list(sizes)
+        if self.journal is not None:
+            self.journal.record(OP_CLEAR, side.side, 0, 0)
+            self.journal.record_many(OP_UPDATE, side.side, prices, sizes)
+        side.load(prices, sizes)
+        if self._subscriptions:
+            self._notify()
+
+    def cumulative_size(self, level, side):
+        """Return the total size of the levels 0 to level of a side.
+
+        :param level: int, index of the deepest level to include
+        :param side: 'bid' or 'ask'
+        :return:
+        """
+        side = self.bids if _is_bid(side) else self.asks
+        return side.cumulative_size(level)
+
+    def vwap_for_size(self, qty, side):
+        """Return the volume weighted price to fill qty from the given side.
+
+        :param qty: size to fill
+        :param side: 'bid' or 'ask', the side of the book to consume
+        :return: float
+        """
+        side = self.bids if _is_bid(side) else self.asks
+        return side.vwap_for_size(qty)
+
+    def mid_price(self):
+        return (self.bids.best_price() + self.asks.best_price()) / 2
+
+    def depth_within(self, bps):
+        """Return the bid and ask size quoted within bps basis points of mid.
+
+        :param bps: distance from mid price in basis points
+        :return: tuple of bid size, ask size
+        """
+        mid = self.mid_price()
+        offset = mid * bps / 10000
+        return (self.bids.size_within(mid - offset),
+                self.asks.size_within(mid + offset))
 
     def top_level(self):
         return self.bids[0], self.asks[0]
 
+    def top_levels(self, depth=1):
+        """Return the best depth levels of both sides as plain tuples.
+
+        :param depth: number of levels per side
+        :return: tuple of bids and asks, each a tuple of (price, size)
+        """
+        return (tuple((q.price, q.size) for q in self.bids[:depth]),
+                tuple((q.price, q.size) for q in self.asks[:depth]))
+
+    def subscribe(self, callback, depth=1, interval=None):
+        """Call callback whenever the best depth levels of the book change.
+
+        The callback receives the result of top_levels(depth). Updates that
+        leave these levels untouched do not trigger it. If interval is given,
+        notifications are coalesced: after one is sent, changes within the
+        next interval seconds are held back and only the latest state is
+        delivered, from a timer thread, once the interval has passed.
+
+        :param callback: callable, e.g. Publisher.publish
+        :param depth: number of levels per side to watch
+        :param interval: minimum seconds between two notifications
+        :return: subscription to pass to unsubscribe()
+        """
+        subscription = _TopSubscription(callback, depth, interval,
+                                        self.top_levels(depth))
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self._subscriptions.remove(subscription)
+        subscription.cancel()
+
+    def _notify(self):
+        depth = max(s.depth for s in self._subscriptions)
+        bids, asks = self.top_levels(depth)
+        for subscription in self._subscriptions:
+            subscription.offer((bids[:subscription.depth],
+                                asks[:subscription.depth]))
+
+
+class _TopSubscription:
+    """Delivers top of book changes to a callback, optionally throttled."""
+    def __init__(self, callback, depth, interval, top):
+        self.callback = callback
+        self.depth = depth
+        self.interval = interval
+        self._top = top
+        self._sent = top
+        self._last_sent_at = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def offer(self, top):
+        if top == self._top:
+            return
+        self._top = top
+        if self.interval is None:
+            self._sent = top
+            self.callback(top)
+            return
+        with self._lock:
+            if self._timer is not None:
+                return
+            now = time.monotonic()
+            if (self._last_sent_at is None or
+                    now - self._last_sent_at >= self.interval):
+                self._last_sent_at = now
+                self._sent = top
+            else:
+                wait = self.interval - (now - self._last_sent_at)
+                self._timer = threading.Timer(wait, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+                return
+        self.callback(top)
+
+    def _flush(self):
+        with self._lock:
+            self._timer = None
+            top = self._top
+            if top == self._sent:
+                return
+            self._last_sent_at = time.monotonic()
+            self._sent = top
+        self.callback(top)
+
+    def cancel(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+
+OP_ADD, OP_UPDATE, OP_CANCEL, OP_MODIFY, OP_CLEAR = range(5)
+
+#: Journal record: timestamp (ns), op, side (1 = bid), price, size, order id.
+_RECORD = struct.Struct('<qBB6xddq')
+_NO_ORDER_ID = -1
+
+
+class LedgerJournal:
+    """Append-only binary journal of the changes applied to a Ledger.
+
+    Records are fixed width (see _RECORD), which lets LedgerReplay seek to
+    any record of a memory-mapped journal directly. Prices and sizes are
+    stored as doubles; None values (e.g. modify() leaving the price as it
+    is) are stored as NaN, and a missing order id as -1. Order ids are
+    stored as signed 64-bit ints, so a journaled level 3 book must use
+    non-negative int order ids; record() rejects any other id.
+    """
+    def __init__(self, path, clock=time.time_ns, buffering=1 << 20):
+        """Initialize instance.
+
+        :param path: file to append records to
+        :param clock: callable returning the timestamp of a record in ns
+        :param buffering: write buffer size in bytes
+        """
+        self.path = path
+        self._clock = clock
+        self._file = open(path, 'ab', buffering=buffering)
+
+    def record(self, op, side, price, size, order_id=None):
+        """Append one change to the journal.
+
+        :raises TypeError: if order_id is not an int
+        :raises ValueError: if order_id is negative or exceeds 64 bits
+        """
+        if order_id is None:
+            order_id = _NO_ORDER_ID
+        elif not isinstance(order_id, int):
+            raise TypeError('LedgerJournal requires int order ids, got %r'
+                            % (order_id,))
+        elif order_id < 0:
+            raise ValueError('LedgerJournal requires non-negative order '
+                             'ids, got %r' % (order_id,))
+        try:
+            record = _RECORD.pack(
+                self._clock(), op, side == 'bid',
+                _NAN if price is None else float(price),
+                _NAN if size is None else float(size), order_id)
+        except struct.error:
+            raise ValueError('LedgerJournal order id %r exceeds 64 bits'
+                             % (order_id,)) from None
+        self._file.write(record)
+
+    def record_many(self, op, side, prices, sizes):
+        if not prices:
+            return
+        ts, pack, is_bid = self._clock(), _RECORD.pack, side == 'bid'
+        self._file.write(b''.join(
+            pack(ts, op, is_bid, float(price), float(size), _NO_ORDER_ID)
+            for price, size in zip(prices, sizes)))
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _capture(ledger):
+    """Return the state of a ledger as a list of Quote field tuples."""
+    state = []
+    for side in (ledger.bids, ledger.asks):
+        for level in side:
+            orders = level.orders.values() if ledger.level3 else (level,)
+            state.extend((q.price, q.size, q.side, q.order_id)
+                         for q in orders)
+    return state
+
+
+class LedgerReplay:
+    """Rebuilds a Ledger from a LedgerJournal, as of any point in time.
+
+    The journal is memory-mapped and records are located by binary search on
+    their timestamps, which are expected to be non-decreasing. While
+    replaying, the state of the book is captured every snapshot_every
+    records, so seeking to a timestamp costs restoring the closest earlier
+    snapshot plus replaying the records after it. Runs of level 2 updates
+    are applied through Ledger.apply_batch().
+    """
+    def __init__(self, path, snapshot_every=1000000, **ledger_kwargs):
+        """Initialize instance.
+
+        :param path: journal file written by LedgerJournal
+        :param snapshot_every: number of records between two snapshots
+        :param ledger_kwargs: passed on to the rebuilt Ledgers
+        """
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._mmap = (mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                      if size else b'')
+        self._count = size // _RECORD.size
+        self.snapshot_every = snapshot_every
+        self._ledger_kwargs = ledger_kwargs
+        self._snapshots = {0: []}
+
+    def __len__(self):
+        return self._count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._mmap:
+            self._mmap.close()
+        self._file.close()
+
+    def timestamp(self, index):
+        return struct.unpack_from('<q', self._mmap, index * _RECORD.size)[0]
+
+    def index_of(self, timestamp):
+        """Return the number of records with a timestamp <= timestamp."""
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp(mid) <= timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def records(self, start=0, stop=None):
+        """Iterate over raw record tuples from start up to stop."""
+        stop = self._count if stop is None else min(stop, self._count)
+        if start >= stop:
+            return iter(())
+        view = memoryview(self._mmap)[start * _RECORD.size:
+                                      stop * _RECORD.size]
+        return _RECORD.iter_unpack(view)
+
+    def ledger_at(self, timestamp=None):
+        """Return a Ledger holding the state of the book at timestamp.
+
+        :param timestamp: in ns, None for the end of the journal
+        :return: Ledger
+        """
+        stop = self._count if timestamp is None else self.index_of(timestamp)
+        return self.ledger_at_index(stop)
+
+    def ledger_at_index(self, stop):
+        """Return a Ledger holding the state after the first stop records."""
+        every = self.snapshot_every
+        start = min(stop // every * every, max(self._snapshots))
+        while start not in self._snapshots:
+            start -= every
+        ledger = Ledger(**self._ledger_kwargs)
+        self._restore(ledger, self._snapshots[start])
+        while start < stop:
+            end = min(stop, (start // every + 1) * every)
+            self.apply(ledger, self.records(start, end))
+            start = end
+            if start % every == 0 and start not in self._snapshots:
+                self._snapshots[start] = _capture(ledger)
+        return ledger
+
+    def _restore(self, ledger, state):
+        if ledger.level3:
+            for price, size, side, order_id in state:
+                ledger.add(Quote(price, size, side, order_id))
+            return
+        for name in ('bid', 'ask'):
+            levels = [(price, size) for price, size, side, _ in state
+                      if side == name]
+            ledger.load_snapshot([p for p, _ in levels],
+                                 [s for _, s in levels], name)
+
+    @staticmethod
+    def apply(ledger, records):
+        """Apply raw journal records to a ledger."""
+        prices, sizes, sides = [], [], []
+        for _, op, is_bid, price, size, order_id in records:
+            if op == OP_UPDATE and not ledger.level3:
+                prices.append(price)
+                sizes.append(size)
+                sides.append(is_bid)
+                continue
+            if prices:
+                ledger.apply_batch(prices, sizes, sides)
+                prices, sizes, sides = [], [], []
+            side = 'bid' if is_bid else 'ask'
+            order_id = None if order_id == _NO_ORDER_ID else order_id
+            if op == OP_ADD:
+                ledger.add(Quote(price, size, side, order_id))
+            elif op == OP_UPDATE:
+                ledger.update(Quote(price, size, side, order_id))
+            elif op == OP_CANCEL:
+                ledger.cancel(order_id)
+            elif op == OP_MODIFY:
+                ledger.modify(order_id, None if size != size else size,
+                              None if price != price else price)
+            elif op == OP_CLEAR:
+                ledger.load_snapshot([], [], side)
+        if prices:
+            ledger.apply_batch(prices, sizes, sides)
+
+
+def _publish_top(ledger, slot, seqs, tops):
+    """Write the top of a ledger into its slot of the shared tops array.
+
+    Uses a sequence lock: the slot's counter is odd while the write is in
+    progress, so readers can detect and retry torn reads without locking.
+    """
+    bid = ledger.bids[0] if len(ledger.bids) else None
+    ask = ledger.asks[0] if len(ledger.asks) else None
+    seqs[slot] += 1
+    i = slot * 4
+    tops[i:i + 4] = [
+        float(bid.price) if bid else _NAN, float(bid.size) if bid else _NAN,
+        float(ask.price) if ask else _NAN, float(ask.size) if ask else _NAN]
+    seqs[slot] += 1
+
+
+def _shard_worker(shard, queue, seqs, tops, processed, ledger_kwargs):
+    """Apply the updates routed to a shard and publish its tops of book.
+
+    An update that raises is logged and skipped, so one bad update neither
+    stops the shard nor holds up flush().
+
+    :param queue: receives (slot, method name, args) tuples, None to stop
+    """
+    ledgers = {}
+    while True:
+        messages = queue.get()
+        if messages is None:
+            return
+        touched = set()
+        for slot, method, args in messages:
+            ledger = ledgers.get(slot)
+            if ledger is None:
+                ledger = ledgers[slot] = Ledger(**ledger_kwargs)
+            try:
+                getattr(ledger, method)(*args)
+            except Exception:
+                log.exception('Shard %d failed to apply %s%r to slot %d',
+                              shard, method, args, slot)
+            touched.add(slot)
+        for slot in touched:
+            _publish_top(ledgers[slot], slot, seqs, tops)
+        processed[shard] += len(messages)
+
+
+class LedgerBook:
+    """Ledgers for many instruments, keyed by symbol.
+
+    With processes=None all Ledgers live in this process. Otherwise symbols
+    are sharded across that many worker processes by a stable hash of the
+    symbol; add(), update() and cancel() are queued to the owning worker,
+    which publishes the top of book of each symbol into shared memory, so
+    top_level() reads it without a round trip through a pipe. Tops read this
+    way lag queued updates until the worker has applied them; call flush()
+    to wait for that.
+    """
+    def __init__(self, processes=None, max_symbols=1024, batch_size=1,
+                 **ledger_kwargs):
+        """Initialize instance.
+
+        :param processes: number of worker processes, None for in-process
+        :param max_symbols: number of shared top-of-book slots to allocate
+        :param batch_size: number of updates to buffer per shard before
+            handing them to the worker in one message
+        :param ledger_kwargs: passed on to each Ledger
+        """
+        self._ledger_kwargs = ledger_kwargs
+        self._ledgers = {}
+        self._processes = processes
+        if not processes:
+            return
+        self._max_symbols = max_symbols
+        self._batch_size = batch_size
+        self._slots = {}
+        self._seqs = mp.RawArray('Q', max_symbols)
+        self._tops = mp.RawArray('d', max_symbols * 4)
+        self._processed = mp.RawArray('Q', processes)
+        self._sent = [0] * processes
+        self._pending = [[] for _ in range(processes)]
+        self._queues = [mp.Queue() for _ in range(processes)]
+        self._workers = [
+            mp.Process(target=_shard_worker, daemon=True,
+                       args=(shard, queue, self._seqs, self._tops,
+                             self._processed, ledger_kwargs))
+            for shard, queue in enumerate(self._queues)]
+        for worker in self._workers:
+            worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def shard_of(self, symbol):
+        return zlib.crc32(symbol.encode('utf-8')) % self._processes
+
+    def _register(self, symbol):
+        if len(self._slots) >= self._max_symbols:
+            raise ValueError('LedgerBook is limited to %d symbols'
+                             % self._max_symbols)
+        slot = len(self._slots)
+        i = slot * 4
+        self._tops[i:i + 4] = [_NAN] * 4
+        self._slots[symbol] = slot, self.shard_of(symbol)
+        return self._slots[symbol]
+
+    def _route(self, symbol, method, *args):
+        if not self._processes:
+            ledger = self._ledgers.get(symbol)
+            if ledger is None:
+                ledger = self._ledgers[symbol] = Ledger(**self._ledger_kwargs)
+            return getattr(ledger, method)(*args)
+        try:
+            slot, shard = self._slots[symbol]
+        except KeyError:
+            slot, shard = self._register(symbol)
+        pending = self._pending[shard]
+        pending.append((slot, method, args))
+        if len(pending) >= self._batch_size:
+            self._send(shard)
+
+    def _send(self, shard):
+        pending = self._pending[shard]
+        if pending:
+            self._queues[shard].put(pending)
+            self._sent[shard] += len(pending)
+            self._pending[shard] = []
+
+    def add(self, symbol, order):
+        return self._route(symbol, 'add', order)
+
+    def update(self, symbol, order):
+        return self._route(symbol, 'update', order)
+
+    def cancel(self, symbol, order_id):
+        return self._route(symbol, 'cancel', order_id)
+
+    def __getitem__(self, symbol):
+        """Return the Ledger of a symbol; only available in-process."""
+        if self._processes:
+            raise TypeError('Ledgers of a sharded LedgerBook live in its '
+                            'worker processes')
+        return self._ledgers[symbol]
+
+    def __contains__(self, symbol):
+        if self._processes:
+            return symbol in self._slots
+        return symbol in self._ledgers
+
+    def symbols(self):
+        return list(self._slots if self._processes else self._ledgers)
+
+    def top_level(self, symbol):
+        """Return the best bid and ask Quote of a symbol.
+
+        :raises KeyError: if the symbol is unknown
+        :raises IndexError: if either side of its book is empty
+        :raises RuntimeError: if the worker owning the symbol died
+        """
+        if not self._processes:
+            return self._ledgers[symbol].top_level()
+        slot, shard = self._slots[symbol]
+        self._check_worker(shard)
+        i = slot * 4
+        seqs, tops = self._seqs, self._tops
+        while True:
+            seq = seqs[slot]
+            if seq & 1:
+                continue
+            bid_price, bid_size, ask_price, ask_size = tops[i:i + 4]
+            if seqs[slot] == seq:
+                break
+        if bid_price != bid_price or ask_price != ask_price:
+            raise IndexError('%s has an empty side' % symbol)
+        return (Quote(bid_price, bid_size, 'bid'),
+                Quote(ask_price, ask_size, 'ask'))
+
+    def flush(self, timeout=None):
+        """Send buffered updates and wait until the workers applied them.
+
+        :param timeout: seconds to wait at most, None to wait indefinitely
+        :return: True if all updates were applied, else False
+        :raises RuntimeError: if a worker died before applying them
+        """
+        if not self._processes:
+            return True
+        for shard in range(self._processes):
+            self._send(shard)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for shard, sent in enumerate(self._sent):
+            while self._processed[shard] < sent:
+                self._check_worker(shard)
+                if deadline is not None and time.monotonic() > deadline:
+                    return False
+                time.sleep(0.0005)
+        return True
+
+    def _check_worker(self, shard):
+        # After close() the workers are gone, but their last tops stay valid.
+        if self._workers and not self._workers[shard].is_alive():
+            raise RuntimeError('LedgerBook worker of shard %d exited with '
+                               'code %s' % (shard,
+                                            self._workers[shard].exitcode))
+
+    def close(self):
+        """Stop the worker processes after they applied pending updates.
 
+        The last published tops remain readable via top_level().
+        """
+        if not self._processes or not self._workers:
+            return
+        for shard, queue in enumerate(self._queues):
+            self._send(shard)
+            queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
@@ -0,0 +1,160 @@
+"""Benchmarks for patterns.ledger.
+
+Usage:
+
+>python ledger_bench.py --levels 1000000 --batch 1000
+>python ledger_bench.py --levels 1000000 --level3 --mix 0.5 0.3 0.2
+>python ledger_bench.py --levels 1000000 --replay
+
+"""
+# Import Built-ins
+import argparse
+import os
+import random
+import tempfile
+import time
+from array import array
+
+# Import Homebrew libs
+from ledger import Ledger, LedgerJournal, LedgerReplay, Quote
+
+
+def generate_updates(n, seed=0, mid=10000, spread=500):
+    """Generate n random level updates around a mid price.
+
+    Roughly one in five updates removes a level (size 0).
+
+    :return: tuple of prices, sizes and sides as array.array
+    """
+    rnd = random.Random(seed)
+    prices, sizes, sides = array('d'), array('d'), array('b')
+    for _ in range(n):
+        is_bid = rnd.random() < 0.5
+        offset = rnd.randint(1, spread)
+        prices.append(mid - offset if is_bid else mid + offset)
+        sizes.append(0 if rnd.random() < 0.2 else rnd.randint(1, 100))
+        sides.append(is_bid)
+    return prices, sizes, sides
+
+
+def bench_update(prices, sizes, sides, tick_size=None):
+    ledger = Ledger(tick_size)
+    start = time.perf_counter()
+    for price, size, side in zip(prices, sizes, sides):
+        ledger.update(Quote(price, size, 'bid' if side else 'ask'))
+    return time.perf_counter() - start, ledger
+
+
+def bench_apply_batch(prices, sizes, sides, batch, tick_size=None):
+    start = time.perf_counter()
+    ledger = bench_apply_batch_into(Ledger(tick_size), prices, sizes, sides,
+                                    batch)
+    return time.perf_counter() - start, ledger
+
+
+def generate_order_flow(n, seed=0, mid=10000, spread=500,
+                        mix=(0.5, 0.3, 0.2)):
+    """Generate n level 3 operations from an add/cancel/modify mix.
+
+    :return: list of ('add', Quote) / ('cancel', id) / ('modify', id, size)
+    """
+    rnd = random.Random(seed)
+    add_p, cancel_p, _ = mix
+    live, ops, next_id = [], [], 0
+    for _ in range(n):
+        roll = rnd.random()
+        if roll < add_p or not live:
+            is_bid = rnd.random() < 0.5
+            offset = rnd.randint(1, spread)
+            price = mid - offset if is_bid else mid + offset
+            ops.append(('add', Quote(price, rnd.randint(1, 100),
+                                     'bid' if is_bid else 'ask', next_id)))
+            live.append(next_id)
+            next_id += 1
+            continue
+        # Swap-remove keeps picking a random live order O(1).
+        i = rnd.randrange(len(live))
+        order_id = live[i]
+        if roll < add_p + cancel_p:
+            live[i] = live[-1]
+            live.pop()
+            ops.append(('cancel', order_id))
+        else:
+            ops.append(('modify', order_id, rnd.randint(1, 100)))
+    return ops
+
+
+def bench_level3(ops, tick_size=None):
+    ledger = Ledger(tick_size, level3=True)
+    add, cancel, modify = ledger.add, ledger.cancel, ledger.modify
+    start = time.perf_counter()
+    for op in ops:
+        if op[0] == 'add':
+            add(op[1])
+        elif op[0] == 'cancel':
+            cancel(op[1])
+        else:
+            modify(op[1], op[2])
+    return time.perf_counter() - start, ledger
+
+
+def bench_replay(prices, sizes, sides, batch):
+    """Journal a batched replay, then time rebuilding the book from it."""
+    fd, path = tempfile.mkstemp(suffix='.journal')
+    os.close(fd)
+    try:
+        with LedgerJournal(path) as journal:
+            bench_apply_batch_into(Ledger(journal=journal), prices, sizes,
+                                   sides, batch)
+        with LedgerReplay(path) as replay:
+            start = time.perf_counter()
+            replay.ledger_at()
+            return time.perf_counter() - start, len(replay)
+    finally:
+        os.remove(path)
+
+
+def bench_apply_batch_into(ledger, prices, sizes, sides, batch):
+    for i in range(0, len(prices), batch):
+        ledger.apply_batch(prices[i:i + batch], sizes[i:i + batch],
+                           sides[i:i + batch])
+    return ledger
+
+
+def report(name, n, elapsed):
+    print('%-12s %10d updates in %7.3fs  %12.0f updates/s'
+          % (name, n, elapsed, n / elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--levels', type=int, default=1000000)
+    parser.add_argument('--batch', type=int, default=1000)
+    parser.add_argument('--tick-size', type=float, default=None)
+    parser.add_argument('--level3', action='store_true',
+                        help='benchmark an add/cancel/modify order flow')
+    parser.add_argument('--replay', action='store_true',
+                        help='benchmark rebuilding the book from a journal')
+    parser.add_argument('--mix', type=float, nargs=3, default=(0.5, 0.3, 0.2),
+                        metavar=('ADD', 'CANCEL', 'MODIFY'))
+    args = parser.parse_args()
+
+    if args.level3:
+        ops = generate_order_flow(args.levels, mix=args.mix)
+        elapsed, _ = bench_level3(ops, args.tick_size)
+        report('level3', len(ops), elapsed)
+        raise SystemExit()
+
+    prices, sizes, sides = generate_updates(args.levels)
+    if args.replay:
+        elapsed, records = bench_replay(prices, sizes, sides, args.batch)
+        report('replay', records, elapsed)
+        raise SystemExit()
+
+    elapsed, by_quote = bench_update(prices, sizes, sides, args.tick_size)
+    report('update', args.levels, elapsed)
+    elapsed, by_batch = bench_apply_batch(prices, sizes, sides, args.batch,
+                                         args.tick_size)
+    report('apply_batch', args.levels, elapsed)
+    assert ([(q.price, q.size) for q in by_quote.bids[:]] ==
+            [(q.price, q.size) for q in by_batch.bids[:]])
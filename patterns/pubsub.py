@@ -1,18 +1,865 @@
 # Import Built-Ins
+import asyncio
+import itertools
+import json
 import logging
+import pickle
+import selectors
 import socket
+import struct
 import os
+import time
+from multiprocessing import shared_memory
 from multiprocessing.connection import Listener, Client
-from queue import Queue, Empty
-from threading import Thread, Event, Timer
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty, Full
+from threading import Thread, Event, Lock, Timer
 
 # Import Third-Party
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 # Import Homebrew
 
 # Init Logging Facilities
 log = logging.getLogger(__name__)
 
+#: Frame types, the first byte of every frame sent by a batching
+#: Distributor: a single message follows as is, while the messages of a
+#: batch each follow as a 4 byte length and their payload.
+FRAME_MESSAGE = b'\x00'
+FRAME_BATCH = b'\x01'
+_LENGTH = struct.Struct('!I')
+
+
+class Codec:
+    """Named pair of functions turning messages into bytes and back."""
+    def __init__(self, name, encode, decode):
+        self.name = name
+        self.encode = encode
+        self.decode = decode
+
+    def __repr__(self):
+        return '<Codec %r>' % self.name
+
+
+#: Default for publish()'s data, telling publish(data) from publish(topic, data).
+_NO_DATA = object()
+
+#: Codecs available to subscribers, by name.
+CODECS = {}
+
+
+def register_codec(name, encode, decode):
+    """Make a codec available for subscribers to choose when attaching.
+
+    :param name: str, name subscribers refer to the codec by
+    :param encode: callable turning a message into a bytes-like object
+    :param decode: callable turning a bytes-like object into a message
+    :return: Codec
+    """
+    CODECS[name] = Codec(name, encode, decode)
+    return CODECS[name]
+
+
+register_codec('pickle', lambda obj: pickle.dumps(obj, pickle.HIGHEST_PROTOCOL),
+               pickle.loads)
+register_codec('raw', lambda data: data, bytes)
+register_codec('json', lambda obj: json.dumps(obj).encode('utf-8'),
+               lambda buf: json.loads(bytes(buf)))
+if msgpack is not None:
+    register_codec('msgpack', msgpack.packb, msgpack.unpackb)
+
+
+def get_codec(codec):
+    """Return the Codec for a codec name, or codec itself if it is one."""
+    if isinstance(codec, Codec):
+        return codec
+    try:
+        return CODECS[codec]
+    except KeyError:
+        raise ValueError('Unknown codec %r' % codec)
+
+
+def pack_batch(payloads):
+    """Join encoded messages into a single frame of a batching Distributor.
+
+    The frame starts with its frame type, so a message's payload is never
+    mistaken for a batch, whatever its first bytes.
+    """
+    if len(payloads) == 1:
+        return FRAME_MESSAGE + payloads[0]
+    parts = [FRAME_BATCH]
+    for payload in payloads:
+        parts.append(_LENGTH.pack(len(payload)))
+        parts.append(payload)
+    return b''.join(parts)
+
+
+def unbatch(frame):
+    """Return the encoded messages contained in a frame from a batching
+    Distributor.
+
+    :param frame: bytes-like frame received via recv_bytes()
+    :return: list of memoryviews, one per message
+    :raises ValueError: if frame does not start with a frame type
+    """
+    frame = memoryview(frame)
+    frame_type = frame[:1]
+    if frame_type == FRAME_MESSAGE:
+        return [frame[1:]]
+    if frame_type != FRAME_BATCH:
+        raise ValueError('Not a frame of a batching Distributor')
+    payloads, offset = [], 1
+    while offset < len(frame):
+        size, = _LENGTH.unpack_from(frame, offset)
+        offset += _LENGTH.size
+        payloads.append(frame[offset:offset + size])
+        offset += size
+    return payloads
+
+
+#: Precedes each message of a sequenced frame: sequence number and length.
+_SEQUENCED = struct.Struct('!QI')
+
+
+def pack_sequenced(items):
+    """Join (sequence number, encoded message) pairs into a sequenced frame.
+
+    Distributors with a retention send all their items in such frames, the
+    replay to a connecting client prefixed with a sequence number; see
+    Distributor.
+    """
+    parts = []
+    for seq, payload in items:
+        parts.append(_SEQUENCED.pack(seq, len(payload)))
+        parts.append(payload)
+    return b''.join(parts)
+
+
+def unpack_sequenced(frame):
+    """Return the messages of a sequenced frame.
+
+    :param frame: bytes-like frame received via recv_bytes()
+    :return: list of (sequence number, memoryview) pairs
+    """
+    frame = memoryview(frame)
+    items, offset = [], 0
+    while offset < len(frame):
+        seq, size = _SEQUENCED.unpack_from(frame, offset)
+        offset += _SEQUENCED.size
+        items.append((seq, frame[offset:offset + size]))
+        offset += size
+    return items
+
+
+def parse_attach_request(request):
+    """Split an attach request into the subscriber address and its options.
+
+    Subscribers either send their address alone, which attaches them with
+    default options, or a dict with an 'address' key plus any of the
+    keyword arguments of Publisher.attach(), such as 'codec' and 'topics'.
+
+    :return: tuple of address, dict of keyword arguments for attach()
+    """
+    if isinstance(request, dict):
+        options = dict(request)
+        address = options.pop('address')
+        unknown = set(options) - _ATTACH_OPTIONS
+        if unknown:
+            raise ValueError('Unknown attach options %r' % sorted(unknown))
+        return address, options
+    return request, {}
+
+
+_ATTACH_OPTIONS = {'codec', 'topics', 'policy', 'transport', 'retention'}
+
+SOCKET = 'socket'
+SHM = 'shm'
+
+
+class TopicIndex:
+    """Trie of topic patterns, mapping topics to the subscribers they match.
+
+    Topics are strings of segments separated by dots. In patterns, '*'
+    matches exactly one segment and '#' matches any number of trailing
+    segments, so 'trades.#' subscribes to every topic below 'trades'.
+    Matching walks one trie level per topic segment, so its cost depends on
+    the topic and the wildcards in use rather than the number of
+    subscribers. Results are cached until the index changes; the cache is
+    also cleared once it holds cache_size topics, so publishing on ever new
+    topics, e.g. one per order id, does not grow it without bound.
+
+    Each trie node is a dict of child nodes by segment; the subscribers of
+    patterns ending at a node are stored under the None key.
+
+    The index is not thread safe: a match() racing a change could walk a
+    trie being modified, or cache a result computed before the change.
+    Publisher hence only uses it under its lock, while AsyncPublisher only
+    uses it from its event loop.
+    """
+    #: Number of topics whose matches are cached at most.
+    cache_size = 4096
+
+    def __init__(self):
+        self._root = {}
+        self._cache = {}
+        self._patterns = {}
+
+    def subscribe(self, subscriber, patterns=None):
+        """Register subscriber for patterns, by default for all topics."""
+        patterns = ['#'] if patterns is None else list(patterns)
+        self._patterns.setdefault(subscriber, []).extend(patterns)
+        for pattern in patterns:
+            self.add(pattern, subscriber)
+
+    def unsubscribe(self, subscriber):
+        """Remove all patterns of subscriber."""
+        for pattern in self._patterns.pop(subscriber, ()):
+            self.remove(pattern, subscriber)
+
+    def add(self, pattern, subscriber):
+        node = self._root
+        for segment in pattern.split('.'):
+            node = node.setdefault(segment, {})
+        node.setdefault(None, set()).add(subscriber)
+        self._cache.clear()
+
+    def remove(self, pattern, subscriber):
+        path = [self._root]
+        segments = pattern.split('.')
+        for segment in segments:
+            node = path[-1].get(segment)
+            if node is None:
+                return
+            path.append(node)
+        subscribers = path[-1].get(None, set())
+        subscribers.discard(subscriber)
+        if not subscribers:
+            path[-1].pop(None, None)
+        # Prune nodes left without subscribers or children.
+        for depth in range(len(segments), 0, -1):
+            if path[depth]:
+                break
+            del path[depth - 1][segments[depth - 1]]
+        self._cache.clear()
+
+    def match(self, topic):
+        """Return the set of subscribers whose patterns match topic."""
+        matched = self._cache.get(topic)
+        if matched is not None:
+            return matched
+        matched = set()
+        nodes = [self._root]
+        for segment in topic.split('.'):
+            next_nodes = []
+            for node in nodes:
+                if '#' in node:
+                    matched.update(node['#'].get(None, ()))
+                for key in (segment, '*'):
+                    child = node.get(key)
+                    if child is not None:
+                        next_nodes.append(child)
+            nodes = next_nodes
+            if not nodes:
+                break
+        for node in nodes:
+            matched.update(node.get(None, ()))
+            if '#' in node:
+                matched.update(node['#'].get(None, ()))
+        if len(self._cache) >= self.cache_size:
+            self._cache.clear()
+        self._cache[topic] = matched
+        return matched
+
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+CONFLATE = 'conflate'
+DISCONNECT = 'disconnect'
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, CONFLATE, DISCONNECT)
+
+
+class SlowConsumerError(Exception):
+    """Raised when a subscriber with the disconnect policy falls behind."""
+
+
+class _OverflowPolicy:
+    """Storage and overflow handling shared by the subscriber queues.
+
+    Items are put as (key, value) tuples and stored in an OrderedDict in
+    arrival order. Under the conflate policy, an item whose key is already
+    queued replaces the queued value in place; all other items get a unique
+    key. When a bounded queue is full, the policy decides what happens:
+
+    - block: wait for room, like a plain Queue
+    - drop-oldest: evict the oldest item, behaving like a ring buffer
+    - drop-newest: discard the new item
+    - conflate: as drop-oldest, once conflation could not absorb the item
+    - disconnect: raise SlowConsumerError
+
+    dropped and conflated count the items lost either way.
+    """
+    def _init(self, maxsize):
+        if self.policy not in POLICIES:
+            raise ValueError('Unknown overflow policy %r' % self.policy)
+        self._items = OrderedDict()
+        self._keys = itertools.count()
+        self.dropped = 0
+        self.conflated = 0
+
+    def _qsize(self):
+        return len(self._items)
+
+    def _put(self, item):
+        key, value = item
+        if key is None or self.policy != CONFLATE:
+            key = (_UNIQUE_KEY, next(self._keys))
+        self._items[key] = value
+
+    def _get(self):
+        return self._items.popitem(last=False)[1]
+
+    def _peek(self):
+        return next(iter(self._items.values()), None)
+
+    def _make_room(self, item):
+        """Apply the overflow policy before putting item.
+
+        :return: True if item was consumed by conflation or dropped
+        """
+        key = item[0]
+        if self.policy == CONFLATE and key is not None and key in self._items:
+            self._items[key] = item[1]
+            self.conflated += 1
+            return True
+        if self.maxsize <= 0 or len(self._items) < self.maxsize:
+            return False
+        if self.policy == DROP_NEWEST:
+            self.dropped += 1
+            return True
+        if self.policy == DISCONNECT:
+            raise SlowConsumerError()
+        self._items.popitem(last=False)
+        self.dropped += 1
+        return False
+
+
+_UNIQUE_KEY = object()
+
+
+class SubscriberQueue(_OverflowPolicy, Queue):
+    """Queue of (key, value) items with an overflow policy."""
+    def __init__(self, maxsize=0, policy=BLOCK):
+        self.policy = policy
+        super(SubscriberQueue, self).__init__(maxsize)
+
+    def put(self, item, block=True, timeout=None):
+        if self.policy == BLOCK:
+            return super(SubscriberQueue, self).put(item, block, timeout)
+        while True:
+            with self.mutex:
+                if self._make_room(item):
+                    return
+            try:
+                return super(SubscriberQueue, self).put(item, False)
+            except Full:
+                # Another producer took the freed slot; decide again.
+                continue
+
+    def peek(self):
+        """Return the oldest queued value without removing it, or None."""
+        with self.mutex:
+            return self._peek()
+
+
+class AsyncSubscriberQueue(_OverflowPolicy, asyncio.Queue):
+    """asyncio.Queue of (key, value) items with an overflow policy."""
+    def __init__(self, maxsize=0, policy=BLOCK):
+        self.policy = policy
+        super(AsyncSubscriberQueue, self).__init__(maxsize)
+
+    def _init(self, maxsize):
+        super(AsyncSubscriberQueue, self)._init(maxsize)
+        # asyncio.Queue sizes itself via len(self._queue).
+        self._queue = self._items
+
+    async def put(self, item):
+        if self.policy == BLOCK:
+            return await super(AsyncSubscriberQueue, self).put(item)
+        self.put_nowait(item)
+
+    def put_nowait(self, item):
+        if self.policy != BLOCK and self._make_room(item):
+            return
+        super(AsyncSubscriberQueue, self).put_nowait(item)
+
+    def peek(self):
+        """Return the oldest queued value without removing it, or None."""
+        return self._peek()
+
+
+class _Sequencer:
+    """Numbers the items of a sequenced subscriber, retaining the latest.
+
+    A subscriber that (re)connects first sends the sequence number of the
+    last item it received, and is replayed the retained items after it that
+    are no longer queued.
+    """
+    def __init__(self, retention):
+        self._seqs = itertools.count(1)
+        self._last = 0
+        self._retained = deque(maxlen=retention)
+        self._lock = Lock()
+
+    def number(self, buf):
+        """Return buf as a (sequence number, buf) item, retaining it."""
+        with self._lock:
+            self._last = next(self._seqs)
+            item = self._last, buf
+            self._retained.append(item)
+        return item
+
+    def replay(self, since, until=None):
+        """Return the replay frame for a client that received up to since.
+
+        The frame starts with the sequence number the replay accounts for,
+        i.e. the one before until or, with nothing queued, the last one
+        numbered, followed by the retained items after since up to it.
+        Whatever the client misses up to that number was not retained.
+
+        :param until: sequence number of the oldest queued item, if any
+        :return: tuple of the frame and the number of items replayed
+        """
+        with self._lock:
+            position = self._last if until is None else until - 1
+            items = [item for item in self._retained
+                     if since < item[0] <= position]
+        return _SEQ.pack(position) + pack_sequenced(items), len(items)
+
+
+def iter_messages(conn, codec='pickle', batched=False):
+    """Yield messages received on a Distributor connection until it closes.
+
+    :param conn: multiprocessing.connection.Connection
+    :param codec: name of the codec negotiated when attaching, or a Codec
+    :param batched: whether the Distributor batches, i.e. its attach reply
+        had 'batched' set; frames are then unpacked via unbatch()
+    """
+    decode = get_codec(codec).decode
+    try:
+        if not batched:
+            while True:
+                yield decode(conn.recv_bytes())
+        while True:
+            for payload in unbatch(conn.recv_bytes()):
+                yield decode(payload)
+    except EOFError:
+        return
+
+
+#: Ring header: sequence number of the next message, capacity, slot size.
+_RING_HEADER = struct.Struct('<QQQ40x')
+#: Slot header: sequence number of the stored message + 1, payload length.
+_SLOT_HEADER = struct.Struct('<QI4x')
+_SEQ = struct.Struct('<Q')
+#: Payload length of a slot standing in for a message too large for it.
+_OVERSIZED = 0xffffffff
+
+
+#: Names of the shared memory blocks created by this process.
+_OWN_SHARED_MEMORY = set()
+
+
+class ShmRing:
+    """Single producer, multiple consumer ring buffer in shared memory.
+
+    Messages are written into fixed size slots, each tagged with the
+    message's sequence number, and the header holds the sequence number of
+    the next message. Readers (see ShmRingReader) poll that header and read
+    payloads in place, so delivery involves neither syscalls nor copies.
+    The writer never waits: readers that fall more than capacity messages
+    behind are lapped and lose the overwritten messages, which they detect
+    from the slot tags. Messages larger than a slot still take up a
+    sequence number, in a slot marked oversized, so readers count them as
+    lost too.
+    """
+    def __init__(self, capacity=4096, slot_size=4096, name=None):
+        """Initialize instance.
+
+        :param capacity: number of slots
+        :param slot_size: maximum payload size in bytes
+        :param name: name of the shared memory block, default random
+        """
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self._stride = _SLOT_HEADER.size + slot_size
+        self._shm = shared_memory.SharedMemory(
+            name=name, create=True,
+            size=_RING_HEADER.size + capacity * self._stride)
+        _OWN_SHARED_MEMORY.add(self._shm.name)
+        self._buf = self._shm.buf
+        _RING_HEADER.pack_into(self._buf, 0, 0, capacity, slot_size)
+        self._seq = 0
+        self._last = None
+        self.oversized = 0
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def written(self):
+        return self._seq - self.oversized
+
+    def write(self, payload):
+        """Append payload to the ring.
+
+        The same buffer object passed twice in a row is written only once,
+        so subscribers sharing a ring may each hand it the same encoded
+        message. Payloads larger than slot_size are counted, and written as
+        an oversized marker in their place.
+
+        :param payload: bytes-like object
+        :return: True if the payload was written
+        """
+        if payload is self._last:
+            return False
+        self._last = payload
+        size = len(payload)
+        seq = self._seq
+        offset = _RING_HEADER.size + (seq % self.capacity) * self._stride
+        buf = self._buf
+        # Invalidate the slot first, so readers notice it is being reused.
+        _SEQ.pack_into(buf, offset, 0)
+        if size > self.slot_size:
+            self.oversized += 1
+            log.debug('Skipping %d byte message for %d byte ring slots',
+                      size, self.slot_size)
+            size = _OVERSIZED
+        else:
+            start = offset + _SLOT_HEADER.size
+            buf[start:start + size] = payload
+        _SLOT_HEADER.pack_into(buf, offset, seq + 1, size)
+        self._seq = seq + 1
+        _SEQ.pack_into(buf, 0, seq + 1)
+        return size != _OVERSIZED
+
+    def close(self):
+        """Release and remove the shared memory block."""
+        self._buf = None
+        self._last = None
+        self._shm.close()
+        self._shm.unlink()
+        _OWN_SHARED_MEMORY.discard(self._shm.name)
+
+
+def _open_shared_memory(name):
+    """Attach to an existing shared memory block without owning it.
+
+    Before Python 3.13, attaching registers the block with this process'
+    resource tracker, which would remove it when this process exits. Blocks
+    created by this process stay registered, as their ShmRing unlinks them.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        if shm.name not in _OWN_SHARED_MEMORY:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class ShmRingReader:
+    """Reads messages from a ShmRing, starting with the next one written.
+
+    lost counts the messages overwritten before they could be read, and
+    those too large for the ring's slots.
+    """
+    #: Seconds to sleep between polls while the ring is drained.
+    poll_interval = 0.0005
+
+    def __init__(self, name, codec='pickle'):
+        self._shm = _open_shared_memory(name)
+        self._buf = self._shm.buf
+        self.codec = get_codec(codec)
+        self._seq, self.capacity, self.slot_size = _RING_HEADER.unpack_from(
+            self._buf, 0)
+        self._stride = _SLOT_HEADER.size + self.slot_size
+        self.lost = 0
+
+    def read(self, max_items=None):
+        """Return the decoded messages written since the last read.
+
+        :param max_items: maximum number of messages to return
+        :return: list
+        """
+        buf, decode = self._buf, self.codec.decode
+        head, = _SEQ.unpack_from(buf, 0)
+        if head - self._seq > self.capacity:
+            self.lost += head - self.capacity - self._seq
+            self._seq = head - self.capacity
+        if max_items is not None:
+            head = min(head, self._seq + max_items)
+        messages = []
+        while self._seq < head:
+            seq = self._seq
+            self._seq += 1
+            offset = _RING_HEADER.size + (seq % self.capacity) * self._stride
+            tag, size = _SLOT_HEADER.unpack_from(buf, offset)
+            if tag != seq + 1 or size == _OVERSIZED:
+                self.lost += 1
+                continue
+            start = offset + _SLOT_HEADER.size
+            payload = buf[start:start + size]
+            try:
+                message = decode(payload)
+            except Exception:
+                if _SEQ.unpack_from(buf, offset)[0] == tag:
+                    raise
+                message = None
+            finally:
+                payload.release()
+            # The writer may have lapped us while we decoded.
+            if _SEQ.unpack_from(buf, offset)[0] != tag:
+                self.lost += 1
+                continue
+            messages.append(message)
+        return messages
+
+    def __iter__(self):
+        """Yield messages as they are written, polling while idle."""
+        while self._buf is not None:
+            messages = self.read()
+            if not messages:
+                time.sleep(self.poll_interval)
+            yield from messages
+
+    def close(self):
+        self._buf = None
+        self._shm.close()
+
+
+class ShmRingNode:
+    """Stands in for a Distributor for subscribers attached via SHM.
+
+    Subscribers with the same codec and topics share one ShmRing, so each
+    message is written once for all of them. The ring is closed once the
+    last of its nodes is joined.
+    """
+    policy = DROP_OLDEST
+
+    def __init__(self, ring, codec, release):
+        self.ring = ring
+        self.codec = codec
+        self._release = release
+        self._alive = False
+
+    @property
+    def attach_reply(self):
+        """Reply telling the subscriber which ring to read from."""
+        return {'transport': SHM, 'name': self.ring.name,
+                'codec': self.codec.name}
+
+    def start(self):
+        self._alive = True
+
+    def is_alive(self):
+        return self._alive
+
+    def join(self, timeout=None):
+        if self._alive:
+            self._alive = False
+            self._release()
+
+    def close(self):
+        self.join()
+
+    def send_bytes(self, buf, block=True, timeout=None, key=None):
+        self.ring.write(buf)
+
+    def stats(self):
+        return {'queued': 0, 'dropped': self.ring.oversized, 'conflated': 0,
+                'written': self.ring.written}
+
+
+class _ShmRings:
+    """Reference counted ShmRings, shared per codec and topic patterns.
+
+    Nodes are handed out while attaching and released while detaching,
+    which may happen on different threads, hence the lock.
+    """
+    def __init__(self, capacity, slot_size):
+        self._capacity = capacity
+        self._slot_size = slot_size
+        self._rings = {}
+        self._lock = Lock()
+
+    def node(self, codec, topics, node_class=ShmRingNode):
+        key = codec.name, None if topics is None else tuple(sorted(topics))
+        with self._lock:
+            if key not in self._rings:
+                self._rings[key] = [ShmRing(self._capacity, self._slot_size),
+                                    0]
+            self._rings[key][1] += 1
+            ring = self._rings[key][0]
+        return node_class(ring, codec, lambda: self._release(key))
+
+    def _release(self, key):
+        with self._lock:
+            entry = self._rings[key]
+            entry[1] -= 1
+            if entry[1]:
+                return
+            del self._rings[key]
+        entry[0].close()
+
+
+class Histogram:
+    """Histogram of durations in nanoseconds, with power of two buckets.
+
+    Recording costs a bit_length() and a few additions; percentiles are
+    reported as the upper bound of their bucket, so within a factor of two.
+    """
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * 65
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, ns):
+        self.buckets[ns.bit_length()] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def percentile(self, fraction):
+        """Return the upper bound in ns of the bucket holding fraction."""
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(1 << i, self.max)
+        return 0
+
+    def snapshot(self):
+        """Return count, mean, percentiles and maximum, in microseconds.
+
+        :return: dict
+        """
+        return {'count': self.count,
+                'mean_us': self.total / self.count / 1e3 if self.count else 0,
+                'p50_us': self.percentile(0.5) / 1e3,
+                'p99_us': self.percentile(0.99) / 1e3,
+                'p999_us': self.percentile(0.999) / 1e3,
+                'max_us': self.max / 1e3}
+
+
+class DistributorMetrics:
+    """What a Distributor sent, and how long items waited to be sent.
+
+    queue_wait times items from being put until their frame was written,
+    send times writing frames to the connection. Items replayed to
+    reconnecting clients (see Distributor) are only counted, as replayed.
+    """
+    __slots__ = ('messages', 'bytes', 'frames', 'replayed', 'queue_wait',
+                 'send')
+
+    def __init__(self):
+        self.messages = 0
+        self.replayed = 0
+        self.bytes = 0
+        self.frames = 0
+        self.queue_wait = Histogram()
+        self.send = Histogram()
+
+    @staticmethod
+    def unstamp(items):
+        """Split items stamped on the way into the queue.
+
+        :return: tuple of the list of stamps, and the list of items
+        """
+        return [item[0] for item in items], [item[1] for item in items]
+
+    def sent(self, stamps, size, started):
+        """Record a frame of size bytes, written since started."""
+        now = time.perf_counter_ns()
+        self.send.record(now - started)
+        for stamp in stamps:
+            self.queue_wait.record(now - stamp)
+        self.messages += len(stamps)
+        self.bytes += size
+        self.frames += 1
+
+    def snapshot(self):
+        return {'messages': self.messages, 'bytes': self.bytes,
+                'frames': self.frames, 'replayed': self.replayed,
+                'queue_wait': self.queue_wait.snapshot(),
+                'send': self.send.snapshot()}
+
+
+class PublisherMetrics:
+    """Where a Publisher spends its time.
+
+    encode times encoding messages, once per codec, enqueue times putting
+    them into subscriber queues, which includes waiting for room under the
+    block policy, and publish times whole publish() calls. attach and
+    control time attach() and the handling of control requests.
+    """
+    __slots__ = ('published', 'encode', 'enqueue', 'publish', 'attach',
+                 'control')
+
+    def __init__(self):
+        self.published = 0
+        self.encode = Histogram()
+        self.enqueue = Histogram()
+        self.publish = Histogram()
+        self.attach = Histogram()
+        self.control = Histogram()
+
+    def snapshot(self):
+        snapshot = {'published': self.published}
+        for name in self.__slots__[1:]:
+            snapshot[name] = getattr(self, name).snapshot()
+        return snapshot
+
+
+class _MetricsReporter(Thread):
+    """Passes Publisher.metrics_snapshot() to callback every interval."""
+    def __init__(self, publisher, callback, interval):
+        super(_MetricsReporter, self).__init__(daemon=True)
+        self._publisher = publisher
+        self._callback = callback
+        self._interval = interval
+        self._stopped = Event()
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self._callback(self._publisher.metrics_snapshot())
+            except Exception:
+                log.exception('Metrics callback failed')
+
+    def stop(self):
+        self._stopped.set()
+
+
+def _attach_reply(node):
+    """Return 'ok', or if node sends unsequenced batches, a dict saying so."""
+    if (node._sequencer is None and node.batch_size is not None
+            and node.batch_size > 1):
+        return {'transport': SOCKET, 'batched': True}
+    return 'ok'
+
 
 class Distributor(Thread):
     """Base Class providing a AF_INET, AF_UNIX or AF_PIPE connection to its
@@ -20,22 +867,85 @@ class Distributor(Thread):
     behaves like a Queue as well as a Thread.
 
     Data from the internal queue is automatically fed to the connecting client.
+
+    Items are queued already encoded by the Distributor's codec, and sent as
+    they are via send_bytes(). Items put() on the Distributor are encoded on
+    the way in, while put_bytes() takes pre-encoded buffers, which lets a
+    Publisher encode each message once for all its subscribers. With the
+    default pickle codec and without batching, frames can still be read by
+    Connection.recv().
+
+    If batch_size is set, up to that many queued items are drained and sent
+    as a single frame, saving a syscall per item; batch_interval bounds how
+    long to wait for a batch to fill up. Every frame then starts with a frame
+    type byte (see pack_batch()), and receivers unpack frames with unbatch()
+    or iter_messages(batched=True). Subscribers attaching through a
+    publisher learn that frames are batched from its reply, attach_reply.
+
+    The policy decides what happens once max_q_size items are queued; see
+    _OverflowPolicy. Under the conflate policy, items put with the same key
+    replace each other while queued.
+
+    With a retention, items are numbered and the latest retention items are
+    kept after sending (see Subscriber). Items are then sent in sequenced
+    frames (see pack_sequenced()), and each connecting client first sends
+    the last sequence number it received, to be replayed the items after
+    it that are no longer queued. The replay frame is sent even if empty,
+    and starts with the sequence number it accounts for, so the client can
+    tell items no longer retained from gaps in the frames after it. As the
+    replay covers items dropped from the queue, retention should be at
+    least max_q_size. Conflation would look like loss to such clients, so
+    the conflate policy cannot be combined with a retention.
+
+    Given a DistributorMetrics, items are stamped as they are put, and
+    metrics records what was sent and how long it took; otherwise the hot
+    path is untouched.
     """
+    #: Seconds between checks of the running flag while the queue is empty.
+    poll_interval = 0.1
+    #: Seconds a client of a sequenced Distributor has to send its position.
+    handshake_timeout = 5.0
+
     def __init__(self, address, max_q_size=None, timeout=None,
-                 *thread_args, **thread_kwargs):
+                 batch_size=None, batch_interval=None, codec='pickle',
+                 policy=BLOCK, retention=None, metrics=None, *thread_args,
+                 **thread_kwargs):
         """Initialize class.
 
         :param sock_name: UDS, TCP socket or pipe name
         :param max_q_size: maximum queue size for self.q, default infinite
+        :param timeout: seconds to wait for a client before shutting down
+        :param batch_size: maximum number of items sent per frame
+        :param batch_interval: seconds to wait for a batch to fill up; by
+            default only items already queued are batched
+        :param codec: name of a registered codec, or a Codec
+        :param policy: overflow policy applied when the queue is full
+        :param retention: number of sent items kept for replay; by default
+            items are neither numbered nor retained
+        :param metrics: DistributorMetrics to record to, default none
         """
+        if retention is not None and policy == CONFLATE:
+            raise ValueError('Conflation cannot be combined with a retention')
         self.address = address
-        self.connector = Listener(address)
         max_q_size = max_q_size if max_q_size else 0
-        self.q = Queue(maxsize=max_q_size)
+        self.q = SubscriberQueue(maxsize=max_q_size, policy=policy)
+        self._sequencer = None if retention is None else _Sequencer(retention)
+        self.metrics = metrics
+        self.connector = Listener(address)
         self._running = Event()
-        self.connection_timer = Timer(timeout, self.connection_timed_out)
+        self._timeout = timeout
+        self._client = None
+        self.connection_timer = None
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.codec = get_codec(codec)
         super(Distributor, self).__init__(*thread_args, **thread_kwargs)
 
+    @property
+    def attach_reply(self):
+        """Reply to the attach request, flagging batched frames."""
+        return _attach_reply(self)
+
     def connection_timed_out(self):
         """Closes the Listener and shutsdown Distributor if no Client connected.
 
@@ -44,67 +954,223 @@ class Distributor(Thread):
 
         :return:
         """
-        self._running.clear()
-        sentinel_conn = Client(self.address)
-        sentinel_conn.close()
-        self.connector.close()
         self.join()
-        os.remove(self.address)
 
     def _start_connection_timer(self):
+        # Timers can only be started once, so each wait gets a fresh one.
+        if self._timeout is None:
+            return
+        self.connection_timer = Timer(self._timeout,
+                                      self.connection_timed_out)
+        self.connection_timer.daemon = True
         self.connection_timer.start()
 
+    def _cancel_connection_timer(self):
+        if self.connection_timer is not None:
+            self.connection_timer.cancel()
+            self.connection_timer = None
+
     def start(self):
         self._running.set()
         super(Distributor, self).start()
 
     def join(self, timeout=None):
+        """Stop feeding data, dropping queued items, and join the thread.
+
+        A connected client is shut down, so that a send_bytes() blocked on a
+        client which stopped reading fails rather than hanging the caller,
+        e.g. a Publisher detaching a slow subscriber.
+        """
         self._running.clear()
+        client = self._client
+        if client is not None:
+            self._shutdown_client(client)
+        elif self.is_alive():
+            # Unblock accept() by connecting to ourselves.
+            try:
+                Client(self.connector.address).close()
+            except OSError:
+                pass
         super(Distributor, self).join(timeout=timeout)
 
+    @staticmethod
+    def _shutdown_client(client):
+        # Shutting down a duplicate of the socket aborts pending sends on
+        # the original, which the feeding thread still owns and closes.
+        try:
+            sock = socket.socket(fileno=os.dup(client.fileno()))
+        except (OSError, ValueError):
+            # Closed meanwhile, or a named pipe rather than a socket.
+            return
+        with sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
     def run(self):
         while self._running.is_set():
             self._start_connection_timer()
             try:
                 client = self.connector.accept()
-                self.connection_timer.cancel()
-                self.feed_data(client)
             except (TimeoutError, socket.timeout, ConnectionError):
                 continue
-            except Exception as e:
-                raise
+            finally:
+                self._cancel_connection_timer()
+            if not self._running.is_set():
+                # Connected by join() to unblock accept().
+                client.close()
+                break
+            self._client = client
+            try:
+                self.feed_data(client)
+            finally:
+                self._client = None
+                client.close()
+        # Frees the address, so the subscriber may attach again.
+        self.connector.close()
 
     def feed_data(self, client):
+        if self._sequencer is not None:
+            return self._feed_sequenced(client)
+        batching = self.batch_size is not None and self.batch_size > 1
+        metrics = self.metrics
+        try:
+            while self._running.is_set():
+                try:
+                    item = self.q.get(timeout=self.poll_interval)
+                except Empty:
+                    continue
+                if metrics is not None:
+                    items = self._drain(item) if batching else [item]
+                    stamps, items = metrics.unstamp(items)
+                    item = pack_batch(items) if batching else items[0]
+                    started = time.perf_counter_ns()
+                    client.send_bytes(item)
+                    metrics.sent(stamps, len(item), started)
+                    continue
+                if batching:
+                    item = pack_batch(self._drain(item))
+                client.send_bytes(item)
+        except (EOFError, OSError):
+            return
+
+    def _feed_sequenced(self, client):
+        """feed_data() for a retention, starting with the client's replay."""
+        batching = self.batch_size is not None and self.batch_size > 1
+        metrics = self.metrics
         try:
+            if not client.poll(self.handshake_timeout):
+                return
+            since, = _SEQ.unpack(client.recv_bytes())
+            frame, replayed = self._sequencer.replay(
+                since, self._oldest_queued_seq())
+            # Sent even when empty, as it tells the client what to expect.
+            client.send_bytes(frame)
+            if metrics is not None:
+                metrics.replayed += replayed
             while self._running.is_set():
                 try:
-                    client.send(self.q.get())
+                    item = self.q.get(timeout=self.poll_interval)
                 except Empty:
+                    # Clients send nothing after their position, so a
+                    # readable connection was closed by the client.
+                    if client.poll():
+                        return
                     continue
-        except EOFError:
+                items = self._drain(item) if batching else [item]
+                if metrics is not None:
+                    stamps, items = metrics.unstamp(items)
+                frame = pack_sequenced(items)
+                started = time.perf_counter_ns()
+                client.send_bytes(frame)
+                if metrics is not None:
+                    metrics.sent(stamps, len(frame), started)
+        except (EOFError, OSError):
             return
 
-    def send(self, data, block=True, timeout=None):
-        self.put(data, block, timeout)
+    def _oldest_queued_seq(self):
+        head = self.q.peek()
+        if head is not None and self.metrics is not None:
+            head = head[1]
+        return None if head is None else head[0]
 
-    def put(self, item, block=True, timeout=None):
-        """put() wrapper around self.q.put()
+    def _drain(self, first):
+        """Collect up to batch_size queued items, starting with first."""
+        items = [first]
+        if self.batch_interval is None:
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self.q.get_nowait())
+                except Empty:
+                    break
+            return items
+        deadline = time.monotonic() + self.batch_interval
+        while len(items) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self.q.get(timeout=remaining))
+            except Empty:
+                break
+        return items
+
+    def send(self, data, block=True, timeout=None, key=None):
+        self.put(data, block, timeout, key)
+
+    def send_bytes(self, buf, block=True, timeout=None, key=None):
+        self.put_bytes(buf, block, timeout, key)
+
+    def put(self, item, block=True, timeout=None, key=None):
+        """put() wrapper around self.q.put(), encoding item first.
 
         :param item:
         :param block:
         :param timeout:
+        :param key: conflation key, see the conflate policy
         :return:
         """
-        self.q.put(item, block, timeout)
+        self.put_bytes(self.codec.encode(item), block, timeout, key)
+
+    def put_bytes(self, buf, block=True, timeout=None, key=None):
+        """Queue an item already encoded with this Distributor's codec.
+
+        :param buf: bytes-like object; it is not copied
+        :param block:
+        :param timeout:
+        :param key: conflation key, see the conflate policy
+        :return:
+        """
+        if self._sequencer is not None:
+            buf = self._sequencer.number(buf)
+        if self.metrics is not None:
+            buf = time.perf_counter_ns(), buf
+        self.q.put((key, buf), block, timeout)
+
+    @property
+    def policy(self):
+        return self.q.policy
+
+    def stats(self):
+        """Return the queue depth and the number of items lost to overflow.
+
+        :return: dict
+        """
+        return {'queued': self.q.qsize(), 'dropped': self.q.dropped,
+                'conflated': self.q.conflated}
 
     def get(self, block=True, timeout=None):
-        """get() wrapper around self.q.get()
+        """get() wrapper around self.q.get(); returns the encoded item.
+
+        With a retention, items are (sequence number, encoded item) pairs.
+        With metrics, items are (perf_counter_ns() when put, item) pairs.
 
         :param block:
         :param timeout:
         :return:
         """
-        self.q.get(block, timeout)
+        return self.q.get(block, timeout)
 
 
 class Publisher:
@@ -113,54 +1179,247 @@ class Publisher:
     Employs basic publish/subscribe model.
     
     Data may be send via any of TCP, UDS or named Windows Pipe.
+
+    Each published message is encoded once per codec in use, and the
+    resulting buffer is shared by all subscribers of that codec.
+
+    Subscribers may attach with a list of topic patterns (see TopicIndex).
+    Messages published with a topic are then only queued for subscribers
+    with a matching pattern, and are delivered as (topic, data) tuples.
+    Subscribers attached without topics receive everything.
+
+    Each subscriber has an overflow policy for when its queue is full (see
+    _OverflowPolicy), so that with max_q_size set a slow subscriber either
+    loses messages or is detached rather than stalling publish(). Under the
+    conflate policy, messages are conflated by topic, or by conflate_key(data)
+    if given. stats() reports the per subscriber counters.
+
+    Subscribers on the same host may attach with transport='shm'. They then
+    read from a ShmRing shared with all SHM subscribers of the same codec and
+    topics, instead of through a socket; the attach reply names the ring.
+    Such rings never block the publisher, so their policy is always
+    drop-oldest. SHM subscribers have no connection the publisher could
+    notice closing, so they send {'detach': subscriber} when done.
+
+    Socket subscribers may attach with a retention, to have their messages
+    numbered and replayed after reconnecting; see Subscriber. Attaching an
+    address again replaces its node.
+
+    With metrics enabled, the publisher and its Distributors record where
+    time goes (see PublisherMetrics and DistributorMetrics), to be pulled
+    via metrics_snapshot() or pushed to metrics_callback every
+    metrics_interval seconds. Disabled, they cost a None check per message.
+
+    handle_conns() reads control requests from all requesters at once, and
+    handles them on a pool of attach_workers threads, so that a storm of
+    subscribers attaching after a restart is neither serialized behind slow
+    requesters nor refused for lack of backlog. Attaching and detaching may
+    hence happen on several threads while publishing.
     """
-    def __init__(self, address, max_q_size=None, timeout=None):
+    #: Seconds between checks of the running flag in handle_conns().
+    poll_interval = 0.1
+
+    def __init__(self, address, max_q_size=None, timeout=None, policy=BLOCK,
+                 shm_capacity=4096, shm_slot_size=4096, metrics=False,
+                 metrics_callback=None, metrics_interval=10.0,
+                 attach_workers=None, backlog=128, batch_size=None,
+                 batch_interval=None):
         """Initialize Instance.
 
         :param sock_name:
         :param max_q_size:
         :param timeout:
+        :param policy: default overflow policy for subscribers
+        :param shm_capacity: number of slots of each ShmRing
+        :param shm_slot_size: maximum message size for SHM subscribers
+        :param metrics: bool, record metrics; implied by metrics_callback
+        :param metrics_callback: callable taking metrics_snapshot()'s result
+        :param metrics_interval: seconds between calls of metrics_callback
+        :param attach_workers: number of threads handling control requests;
+            0 handles them on the handle_conns() thread. By default, one per
+            CPU besides the first, up to 8, as attaching is mostly CPU bound
+        :param backlog: number of control connections waiting to be accepted
+        :param batch_size: maximum number of messages sent per frame to
+            socket subscribers, see Distributor
+        :param batch_interval: seconds to wait for a batch to fill up
         """
         self._address = address
         self._subscribers = set()
         self._subscriber_nodes = {}
+        self._topics = TopicIndex()
         self._running = Event()
-        self.connection = Listener(address)
-        self._node_factory = lambda x: Distributor(x, max_q_size, timeout)
+        self._lock = Lock()
+        if attach_workers is None:
+            attach_workers = min(8, (os.cpu_count() or 1) - 1)
+        self._attach_workers = attach_workers
+        self.connection = Listener(address, backlog=backlog)
+        self._policy = policy
+        self._conflate_keys = {}
+        self._shm_rings = _ShmRings(shm_capacity, shm_slot_size)
+        self._node_factory = lambda x, **kwargs: Distributor(
+            x, max_q_size, timeout, batch_size, batch_interval, **kwargs)
+        metrics = metrics or metrics_callback is not None
+        self.metrics = PublisherMetrics() if metrics else None
+        self._metrics_reporter = None
+        if metrics_callback is not None:
+            self._metrics_reporter = _MetricsReporter(self, metrics_callback,
+                                                      metrics_interval)
+            self._metrics_reporter.start()
 
-    def attach(self, subscriber):
+    def attach(self, subscriber, codec='pickle', topics=None, policy=None,
+               conflate_key=None, transport=SOCKET, retention=None):
         """Attach a subscriber to the publisher.
 
-        :param subscriber: string, UDS Path| TCP Address Tuple | Named Pipe
-        :return:
+        :param subscriber: string, UDS Path| TCP Address Tuple | Named Pipe;
+            with the shm transport, any unique name
+        :param codec: name of the codec to encode messages with, or a Codec
+        :param topics: list of topic patterns to subscribe to, default all;
+            as messages are then (topic, data) tuples, not with codec 'raw'
+        :param policy: overflow policy, defaults to the publisher's
+        :param conflate_key: callable returning the conflation key of the
+            published data, instead of its topic
+        :param transport: 'socket', or 'shm' for same-host subscribers
+        :param retention: number of messages retained for replay, see
+            Distributor; socket transport only
+        :return: the subscriber's node
         """
-        self._subscribers.add(subscriber)
-        self._subscriber_nodes[subscriber] = self._node_factory(subscriber)
-        self._subscriber_nodes[subscriber].start()
+        started = time.perf_counter_ns()
+        codec = get_codec(codec)
+        if transport not in (SOCKET, SHM):
+            raise ValueError('Unknown transport %r' % transport)
+        if transport == SHM and retention is not None:
+            raise ValueError('SHM subscribers cannot have a retention')
+        if topics is not None and codec.name == 'raw':
+            raise ValueError('The raw codec cannot carry the topic of '
+                             'messages, use another one with topics')
+        if subscriber in self._subscriber_nodes:
+            self.detach(subscriber)
+        if transport == SHM:
+            node = self._shm_rings.node(codec, topics)
+        else:
+            node = self._node_factory(
+                subscriber, codec=codec, policy=policy or self._policy,
+                retention=retention,
+                metrics=None if self.metrics is None else DistributorMetrics())
+        node.start()
+        with self._lock:
+            self._conflate_keys[subscriber] = conflate_key
+            self._subscribers.add(subscriber)
+            self._subscriber_nodes[subscriber] = node
+            self._topics.subscribe(subscriber, topics)
+        if self.metrics is not None:
+            self.metrics.attach.record(time.perf_counter_ns() - started)
+        return node
 
     def detach(self, subscriber):
         """Detaches the given subscriber from the publisher.
 
+        Detaching a subscriber that is not attached, e.g. as another thread
+        detached it meanwhile, does nothing.
+
         :param subscriber: string, UDS Path| TCP Address Tuple | Named Pipe
         :return:
         """
-
-        self._subscribers.remove(subscriber)
-        removed_sub = self._subscriber_nodes.pop(subscriber)
+        with self._lock:
+            removed_sub = self._subscriber_nodes.pop(subscriber, None)
+            if removed_sub is None:
+                return
+            self._subscribers.discard(subscriber)
+            self._topics.unsubscribe(subscriber)
+            self._conflate_keys.pop(subscriber, None)
         if removed_sub.is_alive():
             removed_sub.join()
 
-    def publish(self, data):
-        """Publish the given data to all current subscribers.
+    def publish(self, topic, data=_NO_DATA):
+        """Publish the given data to all current subscribers of topic.
+
+        Called with a single argument, that argument is published to all
+        current subscribers, regardless of their topics. Subscribers whose
+        codec fails to encode the message are logged and detached.
 
+        :param topic: str, topic to publish on
         :param data:
         :return:
         """
-        for subscriber in self._subscribers:
-            if self._subscriber_nodes[subscriber].is_alive():
-                self._subscriber_nodes[subscriber].send(data)
+        metrics = self.metrics
+        if metrics is not None:
+            started = time.perf_counter_ns()
+        if data is _NO_DATA:
+            topic, data = None, topic
+            encoded = _Encoder(data, metrics)
+            with self._lock:
+                subscribers = list(self._subscriber_nodes)
+        else:
+            encoded = _Encoder((topic, data), metrics)
+            with self._lock:
+                subscribers = self._topics.match(topic)
+        for subscriber, node in self._live_nodes(subscribers):
+            key = _conflation_key(node, self._conflate_keys.get(subscriber),
+                                  topic, data)
+            try:
+                buf = encoded(node.codec)
+            except Exception:
+                # E.g. a raw subscriber, without topics, of a topic.
+                log.exception('Detaching subscriber %r, whose codec %r '
+                              'failed', subscriber, node.codec.name)
+                self.detach(subscriber)
+                continue
+            if metrics is not None:
+                enqueued = time.perf_counter_ns()
+            try:
+                node.send_bytes(buf, key=key)
+            except SlowConsumerError:
+                log.warning('Detaching slow subscriber %r', subscriber)
+                self.detach(subscriber)
+            if metrics is not None:
+                metrics.enqueue.record(time.perf_counter_ns() - enqueued)
+        if metrics is not None:
+            metrics.published += 1
+            metrics.publish.record(time.perf_counter_ns() - started)
+
+    def stats(self):
+        """Return the queue counters of each subscriber.
+
+        :return: dict of subscriber to Distributor.stats()
+        """
+        with self._lock:
+            nodes = list(self._subscriber_nodes.items())
+        return {subscriber: node.stats() for subscriber, node in nodes}
+
+    def metrics_snapshot(self):
+        """Return the publisher's metrics, and those of each subscriber.
+
+        Subscriber entries hold the stats() counters, with their queue
+        depth, plus the DistributorMetrics of socket subscribers.
+
+        :return: dict, or None if metrics are disabled
+        """
+        if self.metrics is None:
+            return None
+        with self._lock:
+            nodes = list(self._subscriber_nodes.items())
+        subscribers = {}
+        for subscriber, node in nodes:
+            snapshot = node.stats()
+            if getattr(node, 'metrics', None) is not None:
+                snapshot.update(node.metrics.snapshot())
+            subscribers[subscriber] = snapshot
+        return {'time': time.time(), 'publisher': self.metrics.snapshot(),
+                'subscribers': subscribers}
+
+    def _live_nodes(self, subscribers):
+        """Return (subscriber, node) pairs, detaching dead nodes on the way."""
+        nodes = []
+        for subscriber in list(subscribers):
+            node = self._subscriber_nodes.get(subscriber)
+            if node is None:
+                # Detached by another thread meanwhile.
+                continue
+            if node.is_alive():
+                nodes.append((subscriber, node))
             else:
                 self.detach(subscriber)
+        return nodes
 
     def stop(self):
         """Sends shutdown sentinel signal to main loop.
@@ -168,32 +1427,816 @@ class Publisher:
         :return: 
         """
         try:
-            sentinel_conn = Client(self._address)
+            sentinel_conn = Client(self.connection.address)
             sentinel_conn.send('$$$')
         except (EOFError, ConnectionResetError, ConnectionAbortedError):
             pass
         
     def _shut_down(self):
         self._running.clear()
-        for sub in self._subscribers:
+        if self._metrics_reporter is not None:
+            self._metrics_reporter.stop()
+        for sub in list(self._subscribers):
             self.detach(sub)
-        os.remove(self._address)
+        # Closing the Listener also removes a UDS address.
+        self.connection.close()
 
     def handle_conns(self):
+        """Serve control requests until stop() is called.
+
+        The control Listener's socket and all control connections are
+        watched with a selector, and complete requests are handed to the
+        attach_workers pool, if any, which also sends the replies. Named
+        pipes cannot be selected on, so those are served one at a time.
+        """
+        sock = getattr(self.connection._listener, '_socket', None)
+        if sock is None:
+            return self._handle_conns_serially()
+        self._running.set()
+        sock.setblocking(False)
+        pool = None
+        if self._attach_workers:
+            pool = ThreadPoolExecutor(self._attach_workers)
+        with selectors.DefaultSelector() as selector:
+            selector.register(sock, selectors.EVENT_READ)
+            while self._running.is_set():
+                for key, _ in selector.select(self.poll_interval):
+                    if key.fileobj is sock:
+                        self._accept_request(sock, selector)
+                    else:
+                        self._read_request(key, selector, pool)
+            for key in list(selector.get_map().values()):
+                if key.fileobj is not sock:
+                    key.fileobj.close()
+        if pool is not None:
+            pool.shutdown()
+        self._shut_down()
+
+    def _accept_request(self, sock, selector):
+        try:
+            client, _ = sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        client.setblocking(False)
+        selector.register(client, selectors.EVENT_READ,
+                          (bytearray(), time.perf_counter_ns()))
+
+    def _read_request(self, key, selector, pool):
+        client, (buf, started) = key.fileobj, key.data
+        try:
+            chunk = client.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            chunk = b''
+        if not chunk:
+            selector.unregister(client)
+            client.close()
+            return
+        buf.extend(chunk)
+        request = _unframe(buf)
+        if request is None:
+            return
+        selector.unregister(client)
+        if request == '$$$':
+            client.close()
+            self._running.clear()
+            return
+        if pool is None:
+            self._serve_request(client, request, started)
+        else:
+            pool.submit(self._serve_request, client, request, started)
+
+    def _serve_request(self, client, request, started):
+        """Handle request on a worker thread, and reply to its sender."""
+        try:
+            reply = self._handle_request(request)
+        except Exception as e:
+            log.exception('Failed to handle control request %r', request)
+            reply = 'error: %s' % e
+        try:
+            client.setblocking(True)
+            client.sendall(_frame(reply))
+        except OSError:
+            # The requester hung up.
+            pass
+        finally:
+            client.close()
+        if self.metrics is not None:
+            self.metrics.control.record(time.perf_counter_ns() - started)
+
+    def _handle_request(self, request):
+        """Handle an attach or detach request, and return the reply."""
+        if isinstance(request, dict) and 'detach' in request:
+            if request['detach'] in self._subscriber_nodes:
+                self.detach(request['detach'])
+            return 'ok'
+        try:
+            address, options = parse_attach_request(request)
+            node = self.attach(address, **options)
+        except (ValueError, OSError) as e:
+            return 'error: %s' % e
+        return getattr(node, 'attach_reply', 'ok')
+
+    def _handle_conns_serially(self):
+        self._running.set()
         while self._running.is_set():
             try:
                 client = self.connection.accept()
-                sub = client.recv()
-                if sub == '$$$':
-                    self._shut_down()
-                else:
-                    self.attach(sub)
-                client.send('ok')
+                started = time.perf_counter_ns()
+                request = client.recv()
+                if request == '$$$':
+                    client.close()
+                    break
+                client.send(self._handle_request(request))
                 client.close()
-            except EOFError:
+                if self.metrics is not None:
+                    self.metrics.control.record(
+                        time.perf_counter_ns() - started)
+            except (EOFError, OSError):
+                # The requester hung up.
                 continue
-            except Exception as e:
-                raise
+        self._shut_down()
+
+
+def _conflation_key(node, conflate_key, topic, data):
+    if node.policy != CONFLATE:
+        return None
+    return topic if conflate_key is None else conflate_key(data)
+
+
+class _Encoder:
+    """Encodes a message lazily, at most once per codec."""
+    __slots__ = ('_data', '_encoded', '_metrics')
+
+    def __init__(self, data, metrics=None):
+        self._data = data
+        self._encoded = {}
+        self._metrics = metrics
+
+    def __call__(self, codec):
+        buf = self._encoded.get(codec.name)
+        if buf is None:
+            if self._metrics is not None:
+                started = time.perf_counter_ns()
+            buf = memoryview(codec.encode(self._data))
+            if self._metrics is not None:
+                self._metrics.encode.record(time.perf_counter_ns() - started)
+            self._encoded[codec.name] = buf
+        return buf
+
+
+def _frame_header(size):
+    """Return the header multiprocessing's Connection expects before data.
+
+    Connections prefix each message with its length as a signed 32 bit int,
+    or -1 followed by an unsigned 64 bit length for large messages.
+    """
+    if size > 0x7fffffff:
+        return struct.pack('!iQ', -1, size)
+    return struct.pack('!i', size)
+
+
+def _unframe(buf):
+    """Return the object pickled in buf, once buf holds a complete frame
+    as written by multiprocessing's Connection.send, else None.
+    """
+    if len(buf) < 4:
+        return None
+    size, = struct.unpack_from('!i', buf)
+    offset = 4
+    if size == -1:
+        if len(buf) < 12:
+            return None
+        size, = struct.unpack_from('!Q', buf, 4)
+        offset = 12
+    if len(buf) < offset + size:
+        return None
+    return pickle.loads(buf[offset:offset + size])
+
+
+def _frame(obj):
+    """Pickle obj into a frame readable by multiprocessing's Connection.recv."""
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    return _frame_header(len(data)) + data
+
+
+async def _read_bytes(reader):
+    """Read a frame written by a multiprocessing Connection's send_bytes."""
+    size, = struct.unpack('!i', await reader.readexactly(4))
+    if size == -1:
+        size, = struct.unpack('!Q', await reader.readexactly(8))
+    return await reader.readexactly(size)
+
+
+async def _read_frame(reader):
+    return pickle.loads(await _read_bytes(reader))
+
+
+async def _start_server(handler, address):
+    if isinstance(address, str):
+        return await asyncio.start_unix_server(handler, address)
+    return await asyncio.start_server(handler, *address)
+
+
+async def _open_connection(address):
+    if isinstance(address, str):
+        return await asyncio.open_unix_connection(address)
+    return await asyncio.open_connection(*address)
+
+
+class AsyncDistributor:
+    """asyncio counterpart of Distributor.
+
+    Serves a single subscriber from the running event loop, feeding it the
+    encoded items of a bounded asyncio.Queue. Frames are compatible with
+    multiprocessing.connection, so subscribers may keep using Client().
+    Only UDS and TCP addresses are supported.
+
+    A retention works as with Distributor. A client connecting again takes
+    over from its previous connection, which may not have noticed yet that
+    the client closed it, as an idle connection is only written to.
+    """
+    handshake_timeout = Distributor.handshake_timeout
+
+    def __init__(self, address, max_q_size=1024, timeout=None,
+                 batch_size=None, codec='pickle', policy=BLOCK,
+                 retention=None):
+        """Initialize instance.
+
+        :param address: UDS path or TCP address tuple
+        :param max_q_size: maximum number of buffered items
+        :param timeout: seconds to wait for a client before closing
+        :param batch_size: maximum number of items sent per frame
+        :param codec: name of a registered codec, or a Codec
+        :param policy: overflow policy applied when the buffer is full
+        :param retention: number of sent items kept for replay
+        """
+        if retention is not None and policy == CONFLATE:
+            raise ValueError('Conflation cannot be combined with a retention')
+        self.address = address
+        self.q = AsyncSubscriberQueue(maxsize=max_q_size or 0, policy=policy)
+        self._sequencer = None if retention is None else _Sequencer(retention)
+        self._feeder = None
+        self._writer = None
+        self.batch_size = batch_size
+        self.codec = get_codec(codec)
+        self._timeout = timeout
+        self._server = None
+        self._timer = None
+        self._connected = False
+
+    @property
+    def attach_reply(self):
+        """Reply to the attach request, flagging batched frames."""
+        return _attach_reply(self)
+
+    async def start(self):
+        self._server = await _start_server(self._feed_data, self.address)
+        if self._timeout is not None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self._timeout, self._connection_timed_out)
+
+    def is_alive(self):
+        return self._server is not None
+
+    def _connection_timed_out(self):
+        if not self._connected:
+            log.debug('No client connected to %r, closing', self.address)
+            self.close()
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._feeder is not None:
+            self._feeder.cancel()
+            self._feeder = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            if isinstance(self.address, str) and os.path.exists(self.address):
+                os.remove(self.address)
+
+    async def _feed_data(self, reader, writer):
+        if self._sequencer is not None:
+            return await self._feed_sequenced(reader, writer)
+        feeder = self._take_over(writer)
+        batching = self.batch_size is not None and self.batch_size > 1
+        try:
+            while True:
+                item = await self.q.get()
+                if batching:
+                    items = [item]
+                    while len(items) < self.batch_size and not self.q.empty():
+                        items.append(self.q.get_nowait())
+                    item = pack_batch(items)
+                writer.write(_frame_header(len(item)))
+                writer.write(item)
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._release(feeder, writer)
+
+    def _take_over(self, writer):
+        """Make the running task the feeder, cancelling the previous one."""
+        if self._feeder is not None:
+            self._feeder.cancel()
+        self._feeder = asyncio.current_task()
+        self._writer = writer
+        self._connected = True
+        return self._feeder
+
+    def _release(self, feeder, writer):
+        if self._feeder is feeder:
+            self._feeder = self._writer = None
+            self._connected = False
+        writer.close()
+
+    async def _feed_sequenced(self, reader, writer):
+        feeder = self._take_over(writer)
+        batching = self.batch_size is not None and self.batch_size > 1
+        try:
+            since, = _SEQ.unpack(await asyncio.wait_for(
+                _read_bytes(reader), self.handshake_timeout))
+            head = self.q.peek()
+            frame, _ = self._sequencer.replay(
+                since, None if head is None else head[0])
+            while True:
+                writer.write(_frame_header(len(frame)))
+                writer.write(frame)
+                await writer.drain()
+                items = [await self.q.get()]
+                while (batching and len(items) < self.batch_size
+                       and not self.q.empty()):
+                    items.append(self.q.get_nowait())
+                frame = pack_sequenced(items)
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.TimeoutError, asyncio.CancelledError):
+            pass
+        finally:
+            self._release(feeder, writer)
+
+    async def send(self, data, key=None):
+        await self.put(data, key)
+
+    async def send_bytes(self, buf, key=None):
+        await self.put_bytes(buf, key)
+
+    async def put(self, item, key=None):
+        await self.put_bytes(self.codec.encode(item), key)
+
+    async def put_bytes(self, buf, key=None):
+        if self._sequencer is not None:
+            buf = self._sequencer.number(buf)
+        await self.q.put((key, buf))
+
+    async def get(self):
+        return await self.q.get()
+
+    @property
+    def policy(self):
+        return self.q.policy
+
+    def stats(self):
+        return {'queued': self.q.qsize(), 'dropped': self.q.dropped,
+                'conflated': self.q.conflated}
+
+
+class _AsyncShmRingNode(ShmRingNode):
+    """ShmRingNode with the coroutine send_bytes() AsyncPublisher awaits."""
+    async def send_bytes(self, buf, key=None):
+        self.ring.write(buf)
+
+
+class AsyncPublisher:
+    """asyncio implementation of the Publisher API.
+
+    All subscribers are served from one event loop, each via an
+    AsyncDistributor with a bounded buffer, instead of a thread per
+    subscriber. attach(), detach(), publish(), stop() and handle_conns() are
+    coroutines; the control protocol, topic handling and transports are
+    the same as Publisher's, so existing subscribers can attach unchanged.
+    """
+    def __init__(self, address, max_q_size=1024, timeout=None,
+                 batch_size=None, policy=BLOCK, shm_capacity=4096,
+                 shm_slot_size=4096):
+        """Initialize Instance.
+
+        :param address: UDS path or TCP address tuple for control requests
+        :param max_q_size: buffer size per subscriber
+        :param timeout: seconds a subscriber has to connect after attaching
+        :param batch_size: maximum number of items sent per frame
+        :param policy: default overflow policy for subscribers
+        :param shm_capacity: number of slots of each ShmRing
+        :param shm_slot_size: maximum message size for SHM subscribers
+        """
+        self._address = address
+        self._subscriber_nodes = {}
+        self._topics = TopicIndex()
+        self._server = None
+        self._stopped = None
+        self._policy = policy
+        self._conflate_keys = {}
+        self._shm_rings = _ShmRings(shm_capacity, shm_slot_size)
+        self._node_factory = lambda x, **kwargs: AsyncDistributor(
+            x, max_q_size, timeout, batch_size, **kwargs)
+
+    async def attach(self, subscriber, codec='pickle', topics=None,
+                     policy=None, conflate_key=None, transport=SOCKET,
+                     retention=None):
+        """Attach a subscriber to the publisher.
+
+        :param subscriber: string, UDS Path | TCP Address Tuple; with the shm
+            transport, any unique name
+        :param codec: name of the codec to encode messages with, or a Codec
+        :param topics: list of topic patterns to subscribe to, default all;
+            as messages are then (topic, data) tuples, not with codec 'raw'
+        :param policy: overflow policy, defaults to the publisher's
+        :param conflate_key: callable returning the conflation key of the
+            published data, instead of its topic
+        :param transport: 'socket', or 'shm' for same-host subscribers
+        :param retention: number of messages retained for replay, see
+            Distributor; socket transport only
+        :return: the subscriber's node
+        """
+        codec = get_codec(codec)
+        if transport not in (SOCKET, SHM):
+            raise ValueError('Unknown transport %r' % transport)
+        if transport == SHM and retention is not None:
+            raise ValueError('SHM subscribers cannot have a retention')
+        if topics is not None and codec.name == 'raw':
+            raise ValueError('The raw codec cannot carry the topic of '
+                             'messages, use another one with topics')
+        if subscriber in self._subscriber_nodes:
+            await self.detach(subscriber)
+        if transport == SHM:
+            node = self._shm_rings.node(codec, topics, _AsyncShmRingNode)
+            node.start()
+        else:
+            node = self._node_factory(subscriber, codec=codec,
+                                      policy=policy or self._policy,
+                                      retention=retention)
+            await node.start()
+        self._conflate_keys[subscriber] = conflate_key
+        self._subscriber_nodes[subscriber] = node
+        self._topics.subscribe(subscriber, topics)
+        return node
+
+    async def detach(self, subscriber):
+        """Detaches the given subscriber from the publisher.
+
+        Detaching a subscriber that is not attached does nothing.
+
+        :param subscriber: string, UDS Path | TCP Address Tuple
+        :return:
+        """
+        node = self._subscriber_nodes.pop(subscriber, None)
+        if node is None:
+            return
+        self._topics.unsubscribe(subscriber)
+        self._conflate_keys.pop(subscriber, None)
+        node.close()
+
+    async def publish(self, topic, data=_NO_DATA):
+        """Publish the given data to all current subscribers of topic.
+
+        Called with a single argument, that argument is published to all
+        current subscribers. Waits while the buffer of a subscriber with the
+        block policy is full. The message is encoded once per codec in use;
+        subscribers whose codec fails to encode it are logged and detached.
+
+        :param topic: str, topic to publish on
+        :param data:
+        :return:
+        """
+        if data is _NO_DATA:
+            topic, data = None, topic
+            encoded = _Encoder(data)
+            subscribers = list(self._subscriber_nodes)
+        else:
+            encoded = _Encoder((topic, data))
+            subscribers = list(self._topics.match(topic))
+        for subscriber in subscribers:
+            node = self._subscriber_nodes.get(subscriber)
+            if node is None:
+                # Detached while publish() awaited a previous subscriber.
+                continue
+            if not node.is_alive():
+                await self.detach(subscriber)
+                continue
+            key = _conflation_key(node, self._conflate_keys.get(subscriber),
+                                  topic, data)
+            try:
+                buf = encoded(node.codec)
+            except Exception:
+                log.exception('Detaching subscriber %r, whose codec %r '
+                              'failed', subscriber, node.codec.name)
+                await self.detach(subscriber)
+                continue
+            try:
+                await node.send_bytes(buf, key=key)
+            except SlowConsumerError:
+                log.warning('Detaching slow subscriber %r', subscriber)
+                await self.detach(subscriber)
+
+    def stats(self):
+        """Return the buffer counters of each subscriber.
+
+        :return: dict of subscriber to AsyncDistributor.stats()
+        """
+        return {subscriber: node.stats()
+                for subscriber, node in self._subscriber_nodes.items()}
+
+    async def stop(self):
+        """Detach all subscribers and stop handling control requests.
+
+        :return:
+        """
+        for subscriber in list(self._subscriber_nodes):
+            await self.detach(subscriber)
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            if isinstance(self._address, str):
+                os.remove(self._address)
+        if self._stopped is not None:
+            self._stopped.set()
+
+    async def _handle_control(self, reader, writer):
+        try:
+            sub = await _read_frame(reader)
+            reply = 'ok'
+            if sub == '$$$':
+                await self.stop()
+            elif isinstance(sub, dict) and 'detach' in sub:
+                if sub['detach'] in self._subscriber_nodes:
+                    await self.detach(sub['detach'])
+            else:
+                try:
+                    address, options = parse_attach_request(sub)
+                    node = await self.attach(address, **options)
+                    reply = getattr(node, 'attach_reply', reply)
+                except (ValueError, OSError) as e:
+                    reply = 'error: %s' % e
+            writer.write(_frame(reply))
+            await writer.drain()
+        except (EOFError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_conns(self):
+        """Serve control requests until stop() is called."""
+        self._stopped = asyncio.Event()
+        self._server = await _start_server(self._handle_control,
+                                           self._address)
+        await self._stopped.wait()
+
+
+class Subscriber:
+    """Client attaching to a Publisher or AsyncPublisher, and consuming
+    the messages it publishes.
+
+    Subscribers attach with a retention, so the publisher numbers their
+    messages and retains the latest ones (see Distributor). Each connection
+    starts with the sequence number of the last message received, and the
+    publisher replays the retained messages after it. Messages in flight
+    when a connection drops are therefore not lost, and reconnecting takes
+    no new attach request. A gap in the sequence numbers, e.g. after the
+    publisher's overflow policy dropped messages, is answered by
+    reconnecting as well, which replays the missing messages if they are
+    still retained; lost counts those that were not.
+
+    If the subscriber's node is gone, e.g. because it timed out waiting
+    for a connection, the subscriber attaches again. Sequence numbers then
+    start over, and messages published in between are not accounted for.
+
+    Messages are consumed by iterating, with either for or async for; the
+    first iteration attaches. A subscriber is used with one of the two.
+    """
+    #: Seconds between attempts to connect to the subscriber's node.
+    reconnect_interval = 0.01
+
+    def __init__(self, publisher, address, codec='pickle', topics=None,
+                 policy=None, retention=1024, timeout=5.0):
+        """Initialize instance.
+
+        :param publisher: control address of the publisher
+        :param address: UDS path or TCP address tuple to receive on
+        :param codec: name of a registered codec, or a Codec
+        :param topics: list of topic patterns to subscribe to, default all
+        :param policy: overflow policy, defaults to the publisher's
+        :param retention: number of messages the publisher retains for replay
+        :param timeout: seconds to keep reconnecting before attaching again
+        """
+        self.publisher = publisher
+        self.address = address
+        self.codec = get_codec(codec)
+        self.topics = topics
+        self.policy = policy
+        self.retention = retention
+        self.timeout = timeout
+        self.last_seq = 0
+        self.lost = 0
+        self.reconnects = 0
+        self._attached = False
+        self._resuming = False
+        self._conn = None
+        self._stream = None
+
+    def _attach_request(self):
+        request = {'address': self.address, 'codec': self.codec.name,
+                   'retention': self.retention}
+        if self.topics is not None:
+            request['topics'] = list(self.topics)
+        if self.policy is not None:
+            request['policy'] = self.policy
+        return request
+
+    def _check_reply(self, reply):
+        if reply != 'ok':
+            raise ValueError('Attaching %r failed: %s' % (self.address, reply))
+        # A new node numbers its messages from the start.
+        self.last_seq = 0
+        self._attached = True
+
+    def _accept(self, frame):
+        """Decode the messages of frame that continue the sequence.
+
+        :return: tuple of the list of messages, and whether a gap was found
+            that calls for a replay
+        """
+        messages, decode = [], self.codec.decode
+        if self._resuming:
+            # The replay right after connecting, up to position; what it
+            # lacks up to there was no longer retained.
+            self._resuming = False
+            position, = _SEQ.unpack_from(frame)
+            for seq, payload in unpack_sequenced(
+                    memoryview(frame)[_SEQ.size:]):
+                if seq > self.last_seq:
+                    self.lost += seq - self.last_seq - 1
+                    self.last_seq = seq
+                    messages.append(decode(payload))
+            if position > self.last_seq:
+                self.lost += position - self.last_seq
+                self.last_seq = position
+            return messages, False
+        for seq, payload in unpack_sequenced(frame):
+            if seq <= self.last_seq:
+                continue
+            if seq > self.last_seq + 1:
+                return messages, True
+            self.last_seq = seq
+            messages.append(decode(payload))
+        return messages, False
+
+    def attach(self):
+        """Send the attach request to the publisher."""
+        conn = Client(self.publisher)
+        try:
+            conn.send(self._attach_request())
+            reply = conn.recv()
+        finally:
+            conn.close()
+        self._check_reply(reply)
+
+    def _connect(self):
+        if not self._attached:
+            self.attach()
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                conn = Client(self.address)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    log.warning('Node for %r is gone, attaching again',
+                                self.address)
+                    self.attach()
+                    deadline = time.monotonic() + self.timeout
+                time.sleep(self.reconnect_interval)
+        conn.send_bytes(_SEQ.pack(self.last_seq))
+        self._conn = conn
+        self._resuming = True
+
+    def _disconnect(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+            self.reconnects += 1
+
+    def receive(self):
+        """Wait for the next messages, reconnecting as needed.
+
+        :return: list of messages
+        """
+        while True:
+            if self._conn is None:
+                self._connect()
+            try:
+                frame = self._conn.recv_bytes()
+            except (EOFError, OSError):
+                self._disconnect()
+                continue
+            messages, gap = self._accept(frame)
+            if gap:
+                self._disconnect()
+            if messages:
+                return messages
+
+    def __iter__(self):
+        while True:
+            yield from self.receive()
+
+    def close(self):
+        """Close the connection and detach from the publisher."""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if self._attached:
+            self._attached = False
+            conn = Client(self.publisher)
+            try:
+                conn.send({'detach': self.address})
+                conn.recv()
+            finally:
+                conn.close()
+
+    async def attach_async(self):
+        """Coroutine version of attach()."""
+        reader, writer = await _open_connection(self.publisher)
+        try:
+            writer.write(_frame(self._attach_request()))
+            reply = await _read_frame(reader)
+        finally:
+            writer.close()
+        self._check_reply(reply)
+
+    async def _connect_async(self):
+        if not self._attached:
+            await self.attach_async()
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                reader, writer = await _open_connection(self.address)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    log.warning('Node for %r is gone, attaching again',
+                                self.address)
+                    await self.attach_async()
+                    deadline = time.monotonic() + self.timeout
+                await asyncio.sleep(self.reconnect_interval)
+        position = _SEQ.pack(self.last_seq)
+        writer.write(_frame_header(len(position)) + position)
+        self._stream = reader, writer
+        self._resuming = True
+
+    def _disconnect_async(self):
+        if self._stream is not None:
+            self._stream[1].close()
+            self._stream = None
+            self.reconnects += 1
+
+    async def receive_async(self):
+        """Coroutine version of receive()."""
+        while True:
+            if self._stream is None:
+                await self._connect_async()
+            try:
+                frame = await _read_bytes(self._stream[0])
+            except (asyncio.IncompleteReadError, ConnectionError):
+                self._disconnect_async()
+                continue
+            messages, gap = self._accept(frame)
+            if gap:
+                self._disconnect_async()
+            if messages:
+                return messages
+
+    async def __aiter__(self):
+        while True:
+            for message in await self.receive_async():
+                yield message
+
+    async def close_async(self):
+        """Coroutine version of close()."""
+        if self._stream is not None:
+            self._stream[1].close()
+            self._stream = None
+        if self._attached:
+            self._attached = False
+            reader, writer = await _open_connection(self.publisher)
+            try:
+                writer.write(_frame({'detach': self.address}))
+                await _read_frame(reader)
+            finally:
+                writer.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,367 @@
+"""Benchmarks for patterns.pubsub.
+
+Usage:
+
+>python pubsub_bench.py --messages 200000 --batch-sizes 1 8 64 512
+
+End-to-end Publisher throughput and latency, swept over message size,
+subscriber count and queue size, with results saved as JSON:
+
+>python pubsub_bench.py --suite publisher --sizes 64 16384 --json out.json
+
+Add --rate to publish at a fixed rate, for latencies below saturation, and
+--batch-sizes to sweep the publisher's batching as well:
+
+>python pubsub_bench.py --suite publisher --sizes 64 --batch-sizes 1 64
+
+Attach latency while 1000 subscribers attach at once, per number of
+threads the publisher handles control requests with:
+
+>python pubsub_bench.py --suite attach --storm 1000 --attach-workers 0 1 8
+
+"""
+# Import Built-ins
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import socket
+import struct
+import tempfile
+import itertools
+import threading
+import time
+from array import array
+from multiprocessing.connection import Client
+
+# Import Homebrew
+from pubsub import Distributor, Publisher, iter_messages
+
+#: Prefix of each publisher benchmark message: time.perf_counter_ns() when
+#: published. perf_counter is system wide on Linux, so subscriber processes
+#: can compare against it.
+_STAMP = struct.Struct('<q')
+
+
+def _consume(address, count, batched, result):
+    """Receive count messages from a Distributor and report the time taken."""
+    conn = Client(address)
+    received = 0
+    start = None
+    for _ in iter_messages(conn, batched=batched):
+        if start is None:
+            start = time.perf_counter()
+        received += 1
+        if received == count:
+            break
+    result.send(time.perf_counter() - start)
+    conn.close()
+
+
+def bench_distributor(address, messages, batch_size, payload=b'x' * 64):
+    """Return messages/sec for feeding messages through a Distributor."""
+    node = Distributor(address, batch_size=batch_size)
+    node.start()
+    receiver, sender = mp.Pipe(duplex=False)
+    consumer = mp.Process(target=_consume, args=(node.connector.address, messages,
+                                        node.attach_reply != 'ok', sender))
+    consumer.start()
+    for _ in range(messages):
+        node.put(payload)
+    elapsed = receiver.recv()
+    consumer.join()
+    node.join()
+    node.connector.close()
+    return messages / elapsed
+
+
+def _subscribe(address, count, batched, result):
+    """Receive count stamped messages, reporting their latencies in ns."""
+    conn = Client(address)
+    result.send('ready')
+    latencies = array('q')
+    for payload in iter_messages(conn, 'raw', batched=batched):
+        latencies.append(time.perf_counter_ns()
+                         - _STAMP.unpack_from(payload)[0])
+        if len(latencies) == count:
+            break
+    result.send_bytes(latencies)
+    conn.close()
+
+
+def percentile(ordered, fraction):
+    """Return the value at fraction of the sorted sequence ordered."""
+    return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+
+def bench_publisher(address, node_addresses, messages, size, max_q_size,
+                    rate=None, batch_size=None):
+    """Publish messages to one subscriber process per node address.
+
+    Publishing as fast as possible measures throughput, but latencies then
+    mostly reflect the time spent queued; pass a rate below the throughput
+    to measure latency without saturating the queues.
+
+    :param rate: messages per second to publish, default as fast as possible
+    :param batch_size: maximum number of messages per frame, see Publisher
+    :return: dict of throughput and end-to-end latency figures
+    """
+    publisher = Publisher(address, max_q_size=max_q_size,
+                          batch_size=batch_size)
+    results, consumers = [], []
+    for node_address in node_addresses:
+        node = publisher.attach(node_address, codec='raw')
+        receiver, sender = mp.Pipe(duplex=False)
+        consumer = mp.Process(target=_subscribe, args=(
+            node.connector.address, messages, node.attach_reply != 'ok',
+            sender))
+        consumer.start()
+        results.append(receiver)
+        consumers.append(consumer)
+    for receiver in results:
+        receiver.recv()
+
+    padding = b'x' * max(size - _STAMP.size, 0)
+    start = time.perf_counter()
+    for i in range(messages):
+        if rate is not None:
+            # sleep() is too coarse for high rates, so spin instead, while
+            # letting the Distributor threads have the GIL.
+            due = start + i / rate
+            while time.perf_counter() < due:
+                time.sleep(0)
+        publisher.publish(_STAMP.pack(time.perf_counter_ns()) + padding)
+    published = time.perf_counter() - start
+    latencies = array('q')
+    for receiver in results:
+        latencies.frombytes(receiver.recv_bytes())
+    elapsed = time.perf_counter() - start
+
+    for consumer in consumers:
+        consumer.join()
+    for subscriber in list(publisher._subscribers):
+        publisher.detach(subscriber)
+    publisher.connection.close()
+
+    latencies = sorted(latencies)
+    return {
+        'msgs_per_sec': messages / elapsed,
+        'deliveries_per_sec': len(latencies) / elapsed,
+        'publish_msgs_per_sec': messages / published,
+        'latency_us': {
+            'p50': percentile(latencies, 0.5) / 1e3,
+            'p99': percentile(latencies, 0.99) / 1e3,
+            'p999': percentile(latencies, 0.999) / 1e3,
+            'max': latencies[-1] / 1e3,
+        },
+    }
+
+
+def _storm(publisher, subscribers, go, result):
+    """Attach each of subscribers from its own thread, once go is set.
+
+    Reports the attach latencies in ns, from connecting to the publisher
+    until its reply arrived, followed by the number of failed attaches.
+    """
+    latencies = array('q')
+    errors = []
+    lock = threading.Lock()
+
+    def attach(subscriber):
+        go.wait()
+        started = time.perf_counter_ns()
+        try:
+            conn = Client(publisher)
+            conn.send({'address': subscriber, 'codec': 'raw'})
+            reply = conn.recv()
+            conn.close()
+        except OSError as e:
+            reply = e
+        with lock:
+            latencies.append(time.perf_counter_ns() - started)
+            if reply != 'ok':
+                errors.append(reply)
+
+    threads = [threading.Thread(target=attach, args=(subscriber,))
+               for subscriber in subscribers]
+    for thread in threads:
+        thread.start()
+    result.send('ready')
+    for thread in threads:
+        thread.join()
+    result.send_bytes(latencies)
+    result.send(len(errors))
+
+
+def bench_attach_storm(address, subscribers, attach_workers, processes=8):
+    """Attach all subscribers at once, from several processes.
+
+    :return: dict of the time the storm took and its attach latencies
+    """
+    publisher = Publisher(address, attach_workers=attach_workers,
+                          backlog=len(subscribers))
+    server = threading.Thread(target=publisher.handle_conns)
+    server.start()
+    go = mp.Event()
+    results, stormers = [], []
+    for i in range(processes):
+        receiver, sender = mp.Pipe(duplex=False)
+        stormer = mp.Process(target=_storm, args=(
+            publisher.connection.address, subscribers[i::processes], go,
+            sender))
+        stormer.start()
+        results.append(receiver)
+        stormers.append(stormer)
+    for receiver in results:
+        receiver.recv()
+
+    start = time.perf_counter()
+    go.set()
+    latencies = array('q')
+    errors = 0
+    for receiver in results:
+        latencies.frombytes(receiver.recv_bytes())
+        errors += receiver.recv()
+    elapsed = time.perf_counter() - start
+
+    for stormer in stormers:
+        stormer.join()
+    publisher.stop()
+    server.join()
+
+    latencies = sorted(latencies)
+    return {
+        'attaches_per_sec': len(latencies) / elapsed,
+        'elapsed_sec': elapsed,
+        'errors': errors,
+        'latency_ms': {
+            'p50': percentile(latencies, 0.5) / 1e6,
+            'p99': percentile(latencies, 0.99) / 1e6,
+            'p999': percentile(latencies, 0.999) / 1e6,
+            'max': latencies[-1] / 1e6,
+        },
+    }
+
+
+def run_attach_suite(args, tmp_dir):
+    """Benchmark attach storms, printing and returning the results."""
+    results = []
+    for transport, address in addresses(tmp_dir):
+        for attach_workers in args.attach_workers:
+            if transport == 'uds' and os.path.exists(address):
+                os.remove(address)
+            result = bench_attach_storm(
+                address, node_addresses(transport, tmp_dir, args.storm),
+                attach_workers)
+            result.update(transport=transport, subscribers=args.storm,
+                          attach_workers=attach_workers)
+            results.append(result)
+            print('%-4s subscribers=%-5d attach_workers=%-3d %8.0f attaches/s'
+                  '  p50 %7.1fms  p99 %7.1fms  max %7.1fms  errors %d'
+                  % (transport, args.storm, attach_workers,
+                     result['attaches_per_sec'], result['latency_ms']['p50'],
+                     result['latency_ms']['p99'],
+                     result['latency_ms']['max'], result['errors']))
+    return results
+
+
+def node_addresses(transport, tmp_dir, count):
+    """Return count subscriber addresses for transport."""
+    if transport == 'uds':
+        return [os.path.join(tmp_dir, 'sub%d.uds' % i) for i in range(count)]
+    # Subscribers are told apart by address, so each needs its own port.
+    ports = []
+    for _ in range(count):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            ports.append(sock.getsockname()[1])
+    return [('127.0.0.1', port) for port in ports]
+
+
+def run_publisher_suite(args, tmp_dir):
+    """Sweep the publisher benchmark, printing and returning its results."""
+    results = []
+    for transport, address in addresses(tmp_dir):
+        for size, subscribers, max_q_size, batch_size in itertools.product(
+                args.sizes, args.subscribers, args.queue_sizes,
+                args.batch_sizes or [1]):
+            if transport == 'uds' and os.path.exists(address):
+                os.remove(address)
+            result = bench_publisher(
+                address, node_addresses(transport, tmp_dir, subscribers),
+                args.messages, size, max_q_size, args.rate, batch_size)
+            result.update(transport=transport, size=size,
+                          subscribers=subscribers, max_q_size=max_q_size,
+                          batch_size=batch_size, messages=args.messages,
+                          rate=args.rate)
+            results.append(result)
+            print('%-4s size=%-6d subscribers=%-3d max_q_size=%-6d '
+                  'batch_size=%-4d %10.0f msgs/s  p50 %8.1fus  '
+                  'p99 %8.1fus  p999 %8.1fus'
+                  % (transport, size, subscribers, max_q_size, batch_size,
+                     result['msgs_per_sec'], result['latency_us']['p50'],
+                     result['latency_us']['p99'],
+                     result['latency_us']['p999']))
+    return results
+
+
+def run_distributor_suite(args, tmp_dir):
+    """Benchmark Distributor batching, printing and returning its results."""
+    results = []
+    for transport, address in addresses(tmp_dir):
+        for batch_size in args.batch_sizes or [1, 8, 64, 512]:
+            if transport == 'uds' and os.path.exists(address):
+                os.remove(address)
+            rate = bench_distributor(address, args.messages, batch_size)
+            results.append({'transport': transport, 'batch_size': batch_size,
+                            'messages': args.messages, 'msgs_per_sec': rate})
+            print('%-4s batch_size=%-5d %12.0f msgs/s'
+                  % (transport, batch_size, rate))
+    return results
+
+
+def addresses(tmp_dir):
+    yield 'uds', os.path.join(tmp_dir, 'bench.uds')
+    yield 'tcp', ('127.0.0.1', 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--batch-sizes', type=int, nargs='+',
+                        help='default 1 8 64 512, or 1 for the publisher '
+                             'suite')
+    parser.add_argument('--suite',
+                        choices=['distributor', 'publisher', 'attach'],
+                        default='distributor')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[64, 1024, 16384])
+    parser.add_argument('--subscribers', type=int, nargs='+',
+                        default=[1, 4, 16])
+    parser.add_argument('--queue-sizes', type=int, nargs='+',
+                        default=[1024, 16384])
+    parser.add_argument('--storm', type=int, default=1000,
+                        help='number of subscribers attaching at once')
+    parser.add_argument('--attach-workers', type=int, nargs='+',
+                        default=[0, 1, 8])
+    parser.add_argument('--rate', type=float,
+                        help='messages/s to publish at, default flat out')
+    parser.add_argument('--json', metavar='PATH',
+                        help='also write the results to PATH as JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.suite == 'publisher':
+            results = run_publisher_suite(args, tmp_dir)
+        elif args.suite == 'attach':
+            results = run_attach_suite(args, tmp_dir)
+        else:
+            results = run_distributor_suite(args, tmp_dir)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'suite': args.suite, 'time': time.time(),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'results': results}, f, indent=2)
@@ -0,0 +1,130 @@
+"""Randomized tests of patterns.ledger against a brute force model.
+
+Usage:
+
+>python -m unittest test_ledger
+
+"""
+# Import Built-ins
+import random
+import unittest
+
+# Import Homebrew
+from ledger import Ledger, Quote
+
+#: Tick sizes to test with: none, one the prices fit in a tick indexed tree,
+#: and one spanning too many ticks for that.
+TICK_SIZES = (None, 0.25, 0.0001)
+
+
+def random_price(rng):
+    # Multiples of 0.25 over enough levels to fill several buckets.
+    return rng.randint(4, 1600) * 0.25
+
+
+class LedgerModelTest(unittest.TestCase):
+
+    def assertMatches(self, ledger, levels, rng):
+        """Compare the ledger's aggregates to those computed from levels.
+
+        :param levels: dict of (side, price) to the total size at it
+        """
+        for side, best_first in (('bid', True), ('ask', False)):
+            book = ledger.bids if side == 'bid' else ledger.asks
+            expected = sorted(((price, size) for (s, price), size
+                               in levels.items() if s == side and size),
+                              reverse=best_first)
+            self.assertEqual([level.price for level in book],
+                             [price for price, _ in expected])
+            sizes = [size for _, size in expected]
+            for level in [0] + [rng.randrange(len(sizes) + 2)
+                                for _ in range(5)]:
+                self.assertEqual(ledger.cumulative_size(level, side),
+                                 sum(sizes[:level + 1]))
+            limit = random_price(rng)
+            self.assertEqual(book.size_within(limit), sum(
+                size for price, size in expected
+                if (price >= limit if best_first else price <= limit)))
+            total = sum(sizes)
+            for qty in (1, rng.randint(1, total + 1), total or 1, total + 1):
+                if qty > total:
+                    with self.assertRaises(ValueError):
+                        ledger.vwap_for_size(qty, side)
+                    continue
+                remaining, cost = qty, 0.0
+                for price, size in expected:
+                    filled = min(size, remaining)
+                    cost += filled * price
+                    remaining -= filled
+                    if not remaining:
+                        break
+                self.assertAlmostEqual(ledger.vwap_for_size(qty, side),
+                                       cost / qty, places=6)
+
+    def test_level2(self):
+        for tick_size in TICK_SIZES:
+            with self.subTest(tick_size=tick_size):
+                rng = random.Random(str(tick_size))
+                ledger, levels = Ledger(tick_size), {}
+                for step in range(2000):
+                    choice = rng.random()
+                    if choice < 0.7:
+                        quote = Quote(random_price(rng), rng.randint(0, 9),
+                                      rng.choice(['bid', 'ask']))
+                        ledger.update(quote)
+                        levels[quote.side, quote.price] = quote.size
+                    elif choice < 0.97:
+                        count = rng.choice([5, 100])
+                        prices = [random_price(rng) for _ in range(count)]
+                        sizes = [rng.randint(0, 9) for _ in range(count)]
+                        sides = [rng.choice(['bid', 'ask'])
+                                 for _ in range(count)]
+                        ledger.apply_batch(prices, sizes, sides)
+                        for level in zip(sides, prices, sizes):
+                            levels[level[:2]] = level[2]
+                    else:
+                        side = rng.choice(['bid', 'ask'])
+                        prices = rng.sample(range(4, 1601), 300)
+                        prices = [price * 0.25 for price in prices]
+                        sizes = [rng.randint(0, 9) for _ in prices]
+                        ledger.load_snapshot(prices, sizes, side)
+                        levels = {key: size for key, size in levels.items()
+                                  if key[0] != side}
+                        levels.update(((side, price), size)
+                                      for price, size in zip(prices, sizes))
+                    if step % 10 == 0:
+                        self.assertMatches(ledger, levels, rng)
+                self.assertMatches(ledger, levels, rng)
+
+    def test_level3(self):
+        for tick_size in TICK_SIZES:
+            with self.subTest(tick_size=tick_size):
+                rng = random.Random(str(tick_size))
+                ledger, orders = Ledger(tick_size, level3=True), {}
+                for order_id in range(3000):
+                    choice = rng.random()
+                    if choice < 0.6 or not orders:
+                        quote = Quote(random_price(rng), rng.randint(1, 9),
+                                      rng.choice(['bid', 'ask']), order_id)
+                    else:
+                        previous = orders[rng.choice(list(orders))]
+                        price = previous.price
+                        if rng.random() < 0.3:
+                            price = random_price(rng)
+                        quote = Quote(price, rng.randint(0, 9),
+                                      previous.side, previous.order_id)
+                    ledger.update(quote)
+                    if quote.size:
+                        orders[quote.order_id] = quote
+                    else:
+                        orders.pop(quote.order_id)
+                    if order_id % 10 == 0:
+                        levels = {}
+                        for order in orders.values():
+                            key = order.side, order.price
+                            levels[key] = levels.get(key, 0) + order.size
+                        self.assertMatches(ledger, levels, rng)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+"""Regression tests for patterns.pubsub.
+
+Usage:
+
+>python -m unittest test_pubsub
+
+"""
+# Import Built-ins
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from multiprocessing.connection import Client
+
+# Import Homebrew
+from pubsub import (DISCONNECT, AsyncDistributor, AsyncPublisher, BLOCK,
+                    Distributor, Publisher, ShmRing, ShmRingReader,
+                    Subscriber, TopicIndex, _SEQ, _Sequencer, iter_messages,
+                    pack_sequenced)
+
+
+class PublisherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def make_publisher(self, **kwargs):
+        publisher = Publisher(os.path.join(self.tmp_dir, 'publisher'),
+                              attach_workers=0, **kwargs)
+        self.addCleanup(publisher._shut_down)
+        return publisher
+
+    def test_disconnecting_stalled_subscriber_does_not_block_publish(self):
+        publisher = self.make_publisher(max_q_size=4, policy=DISCONNECT)
+        address = os.path.join(self.tmp_dir, 'subscriber')
+        publisher.attach(address)
+        # Connects, then never reads, so the node blocks in send_bytes()
+        # once the socket buffers are full.
+        conn = Client(address)
+        self.addCleanup(conn.close)
+        message = b'x' * (1 << 20)
+
+        def publish():
+            for _ in range(20):
+                publisher.publish(message)
+
+        publishing = threading.Thread(target=publish, daemon=True)
+        publishing.start()
+        publishing.join(10)
+        self.assertFalse(publishing.is_alive(), 'publish() hung')
+        self.assertNotIn(address, publisher._subscriber_nodes)
+
+    def test_detach_is_idempotent(self):
+        publisher = self.make_publisher()
+        address = os.path.join(self.tmp_dir, 'subscriber')
+        publisher.attach(address)
+        publisher.detach(address)
+        publisher.detach(address)
+        publisher.publish('data')
+        self.assertEqual(publisher.stats(), {})
+
+    def test_raw_codec_cannot_have_topics(self):
+        publisher = self.make_publisher()
+        with self.assertRaises(ValueError):
+            publisher.attach(os.path.join(self.tmp_dir, 'subscriber'),
+                             codec='raw', topics=['t'])
+
+    def test_failing_codec_does_not_stop_delivery(self):
+        publisher = self.make_publisher()
+        everything = os.path.join(self.tmp_dir, 'everything')
+        raw = os.path.join(self.tmp_dir, 'raw')
+        publisher.attach(raw, codec='raw')
+        publisher.attach(everything)
+        with self.assertLogs('pubsub', 'ERROR'):
+            publisher.publish('t', b'payload')
+        self.assertEqual(publisher.stats()[everything]['queued'], 1)
+        self.assertNotIn(raw, publisher.stats())
+
+    def test_batching_is_passed_to_nodes(self):
+        publisher = self.make_publisher(batch_size=8, batch_interval=0.001)
+        node = publisher.attach(os.path.join(self.tmp_dir, 'subscriber'))
+        self.assertEqual((node.batch_size, node.batch_interval), (8, 0.001))
+        self.assertTrue(node.attach_reply['batched'])
+
+    def test_shm_rings_are_released_across_threads(self):
+        publisher = self.make_publisher()
+
+        def churn(name):
+            for _ in range(50):
+                publisher.attach(name, transport='shm')
+                publisher.detach(name)
+
+        threads = [threading.Thread(target=churn, args=('shm%d' % i,))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(publisher._shm_rings._rings, {})
+
+
+class DistributorTest(unittest.TestCase):
+
+    def test_batched_payloads_are_never_sniffed(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        node = Distributor(os.path.join(tmp_dir, 'subscriber'), codec='raw',
+                           batch_size=8)
+        node.start()
+        self.addCleanup(node.join)
+        # Starts like a batch frame of the former in-band format.
+        payloads = [b'\x00$$batch$$\x00\x00\x00\x01x', b'\x01', b'\x00']
+        for payload in payloads:
+            node.put(payload)
+        conn = Client(node.connector.address)
+        self.addCleanup(conn.close)
+        self.assertTrue(node.attach_reply['batched'])
+        received = iter_messages(conn, 'raw', batched=True)
+        self.assertEqual([next(received) for _ in payloads], payloads)
+
+    def test_replay_is_sent_when_empty(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        node = Distributor(os.path.join(tmp_dir, 'subscriber'), codec='raw',
+                           retention=64)
+        node.start()
+        self.addCleanup(node.join)
+        conn = Client(node.connector.address)
+        self.addCleanup(conn.close)
+        conn.send_bytes(_SEQ.pack(0))
+        self.assertTrue(conn.poll(5))
+        self.assertEqual(conn.recv_bytes(), _SEQ.pack(0))
+
+
+class ShmRingTest(unittest.TestCase):
+
+    def test_oversized_messages_count_as_lost(self):
+        ring = ShmRing(capacity=8, slot_size=64)
+        self.addCleanup(ring.close)
+        reader = ShmRingReader(ring.name, codec='raw')
+        self.addCleanup(reader.close)
+        ring.write(b'first')
+        self.assertFalse(ring.write(b'x' * 65))
+        ring.write(b'last')
+        self.assertEqual(reader.read(), [b'first', b'last'])
+        self.assertEqual(reader.lost, 1)
+        self.assertEqual(ring.written, 2)
+
+
+class TopicIndexTest(unittest.TestCase):
+
+    def test_cache_is_bounded(self):
+        index = TopicIndex()
+        index.cache_size = 8
+        index.subscribe('subscriber', ['orders.#'])
+        for order_id in range(100):
+            self.assertEqual(index.match('orders.%d' % order_id),
+                             {'subscriber'})
+        self.assertLessEqual(len(index._cache), 8)
+
+
+class SubscriberTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sequencer = _Sequencer(retention=64)
+        self.subscriber = Subscriber('publisher', 'subscriber', codec='raw')
+
+    def connect(self, until=None):
+        """Accept the replay as if the subscriber just connected."""
+        self.subscriber._resuming = True
+        frame, _ = self.sequencer.replay(self.subscriber.last_seq, until)
+        return self.subscriber._accept(frame)
+
+    def test_gap_after_empty_replay_is_replayed(self):
+        self.assertEqual(self.connect(), ([], False))
+        # A burst right after connecting, of which drop-oldest only left
+        # the last 8 queued.
+        items = [self.sequencer.number(b'%d' % i) for i in range(30)]
+        queued = pack_sequenced(items[22:])
+        self.assertEqual(self.subscriber._accept(queued), ([], True))
+        messages, gap = self.connect(until=23)
+        self.assertEqual(len(messages), 22)
+        messages, gap = self.subscriber._accept(queued)
+        self.assertEqual(len(messages), 8)
+        self.assertEqual(self.subscriber.lost, 0)
+
+    def test_messages_no_longer_retained_count_as_lost(self):
+        self.sequencer = _Sequencer(retention=4)
+        self.connect()
+        items = [self.sequencer.number(b'%d' % i) for i in range(30)]
+        queued = pack_sequenced(items[22:])
+        self.assertEqual(self.subscriber._accept(queued), ([], True))
+        messages, gap = self.connect(until=23)
+        self.assertEqual((messages, gap), ([], False))
+        self.assertEqual(self.subscriber.lost, 22)
+        messages, gap = self.subscriber._accept(queued)
+        self.assertEqual((len(messages), gap), (8, False))
+
+
+class AsyncPublisherTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.address = os.path.join(self.tmp_dir, 'subscriber')
+
+    async def test_reconnect_after_idle_disconnect(self):
+        node = AsyncDistributor(self.address, codec='raw')
+        await node.start()
+        self.addCleanup(node.close)
+        reader, writer = await asyncio.open_unix_connection(self.address)
+        writer.close()
+        # The node only notices the closed connection once it writes to it,
+        # so connecting again while idle must take over regardless.
+        reader, writer = await asyncio.open_unix_connection(self.address)
+        self.addCleanup(writer.close)
+        await asyncio.sleep(0.05)
+        await node.put(b'data')
+        header = await asyncio.wait_for(reader.readexactly(4), 5)
+        size = int.from_bytes(header, 'big')
+        self.assertEqual(await reader.readexactly(size), b'data')
+
+    async def test_close_stops_feeding(self):
+        node = AsyncDistributor(self.address, codec='raw')
+        await node.start()
+        reader, writer = await asyncio.open_unix_connection(self.address)
+        self.addCleanup(writer.close)
+        await asyncio.sleep(0.05)
+        feeder = node._feeder
+        node.close()
+        self.assertEqual(await asyncio.wait_for(reader.read(), 5), b'')
+        await asyncio.sleep(0)
+        self.assertTrue(feeder.done())
+
+    async def test_publish_skips_subscriber_detached_meanwhile(self):
+        publisher = AsyncPublisher(os.path.join(self.tmp_dir, 'publisher'),
+                                   max_q_size=1, policy=BLOCK)
+        self.addCleanup(publisher.stop)
+        await publisher.attach(self.address)
+        await publisher.attach(self.address + '2')
+        await publisher.publish('fills the first buffer')
+        # Blocks on the full buffer of the first subscriber, while the
+        # second is detached.
+        publishing = asyncio.create_task(publisher.publish('data'))
+        await asyncio.sleep(0.05)
+        await publisher.detach(self.address + '2')
+        publisher._subscriber_nodes[self.address].q.get_nowait()
+        await asyncio.wait_for(publishing, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,18 +12,86 @@ Usage:
 >urlimport.install_path_hook() # install path hook, which looks up addresses starting with http/https
 
 >import package_at_address # start importing.
+
+To keep downloaded sources and their compiled code across processes:
+
+>urlimport.install_cache('/var/cache/urlimport', max_age=300)
+
+To download a whole remote package tree concurrently before importing it:
+
+>urlimport.install_path_hook(prefetch=True)
+
+or, for a single package:
+
+>urlimport.prefetch('http://Remote/Address/package_at_address')
+
+Publishing a manifest next to the packages lets the finders look up the
+whole tree from one request, rather than scraping directory listings:
+
+>urlimport.make_manifest('/srv/www/Address') # writes urlimport.json
+
+Zip archives and wheels on sys.path are imported from too, pulling only
+the members needed with HTTP Range requests, or downloading them once:
+
+>sys.path.append('http://Remote/Address/bundle.whl')
+>urlimport.install_path_hook(download_archives=False)
+
+To create remote modules at once, and only fetch and run them when one of
+their attributes is first used (for modules without import side effects):
+
+>urlimport.install_lazy(warm_up=True) # fetch and compile in the background
+
+Packages are lazy too, though importing a submodule reads the package's
+__path__, which runs the package first.
+
+To find the remote imports that make start up slow, like python -X importtime:
+
+>profile = urlimport.install_profile()
+>import package_at_address
+>print(profile.report(sort='cumulative', limit=10))
+
+Requests go through urllib.request.urlopen(), and so through the opener
+set by urllib.request.install_opener() if any. To rather share a pool of
+kept-alive connections, asking for gzip, which bypasses such an opener's
+handlers (authentication, SSL context, cookies, User-Agent...):
+
+>urlimport.install_pool(max_connections=8)
+>urlimport.remove_pool() # back to urlopen()
 -----
 
 """
 
 # Import Built-Ins
+import atexit
+import contextlib
+import functools
+import gzip
+import hashlib
+import io
+import json
 import logging
+import marshal
+import mmap
+import os
+import re
+import struct
 import sys
+import tempfile
+import time
+import types
+import zipfile
 import importlib.abc
-import imp
-from urllib.request import urlopen
+import importlib.machinery
+import importlib.util
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from urllib.parse import urljoin, urlsplit
+from urllib.request import Request, getproxies, proxy_bypass, urlopen
+from urllib.response import addinfourl
 from urllib.error import HTTPError, URLError
 from html.parser import HTMLParser
+from queue import Queue
 # Import Third-Party
 
 # Import Homebrew
@@ -32,24 +100,789 @@ from html.parser import HTMLParser
 log = logging.getLogger(__name__)
 
 
+#: Flags of hash based pycs whose source hash is checked, see PEP 552.
+_PYC_FLAGS = 0b11
+_PYC_HEADER = struct.Struct('<4sI8s')
+
+
+class UrlCache:
+    """On-disk cache of remote files, and of the code compiled from them.
+
+    Entries are named by the SHA-256 of their URL: <key>.data holds the
+    body, <key>.json the URL, its ETag and Last-Modified headers and when
+    it was last validated, and <key>.pyc the compiled code, in the hash
+    based pyc format __pycache__ uses (PEP 552).
+
+    Entries validated less than max_age seconds ago are used without
+    asking the server; older ones are revalidated with a conditional
+    request, and only downloaded again if they changed.
+    """
+    def __init__(self, directory=None, max_age=0):
+        """Initialize instance.
+
+        :param directory: cache directory, default ~/.cache/urlimport
+        :param max_age: seconds an entry is used without revalidation
+        """
+        if directory is None:
+            directory = os.path.join(os.path.expanduser('~'), '.cache',
+                                     'urlimport')
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_age = max_age
+
+    def _path(self, url, suffix):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + suffix)
+
+    def _write(self, path, data):
+        # Write a temporary file first, so readers never see partial data.
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _read_meta(self, url):
+        try:
+            with open(self._path(url, '.json'), 'rb') as f:
+                meta = json.loads(f.read().decode('utf-8'))
+            with open(self._path(url, '.data'), 'rb') as f:
+                return meta, f.read()
+        except (OSError, ValueError):
+            return None, None
+
+    def _write_meta(self, url, meta):
+        self._write(self._path(url, '.json'), json.dumps(meta).encode('utf-8'))
+
+    def fetch(self, url, opener=None, sha256=None):
+        """Return the body of url, from the cache if it is still valid.
+
+        :param opener: function opening a Request, like urlopen, the
+            connection pool by default if installed
+        :param sha256: hex digest the body is known to have, e.g. from a
+            manifest; a cached body with this digest is used as is
+        :raises HTTPError, URLError: if url could not be fetched
+        """
+        return self._fetch(url, opener or _urlopen, sha256)[0]
+
+    def _fetch(self, url, opener, sha256):
+        # Return the body of url, whether it was a cache 'hit', a 'miss' or
+        # a hit only after it was 'revalidated', and the bytes transferred.
+        meta, data = self._read_meta(url)
+        if meta is not None and time.time() - meta['validated'] < self.max_age:
+            log.debug('cache: %r is fresh', url)
+            return data, 'hit', 0
+        if meta is not None and sha256 and meta.get('sha256') == sha256:
+            log.debug('cache: %r matches its digest', url)
+            return data, 'hit', 0
+        request = Request(url)
+        if meta is not None:
+            if meta.get('etag'):
+                request.add_header('If-None-Match', meta['etag'])
+            if meta.get('last_modified'):
+                request.add_header('If-Modified-Since', meta['last_modified'])
+        try:
+            response = opener(request)
+        except HTTPError as e:
+            if e.code != 304 or meta is None:
+                raise
+            log.debug('cache: %r not modified', url)
+            meta['validated'] = time.time()
+            self._write_meta(url, meta)
+            return data, 'revalidated', 0
+        data = response.read()
+        self._write(self._path(url, '.data'), data)
+        self._write_meta(url, {'url': url,
+                               'etag': response.headers.get('ETag'),
+                               'last_modified':
+                                   response.headers.get('Last-Modified'),
+                               'sha256': hashlib.sha256(data).hexdigest(),
+                               'validated': time.time()})
+        log.debug('cache: %r stored', url)
+        return data, 'miss', _transferred(response, data)
+
+    def get_code(self, url, source):
+        """Return the code cached for url if compiled from source, else None.
+
+        :param source: bytes the code must have been compiled from
+        """
+        try:
+            with open(self._path(url, '.pyc'), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if len(data) < _PYC_HEADER.size:
+            return None
+        magic, flags, source_hash = _PYC_HEADER.unpack_from(data)
+        if (magic != importlib.util.MAGIC_NUMBER or flags != _PYC_FLAGS
+                or source_hash != importlib.util.source_hash(source)):
+            return None
+        try:
+            return marshal.loads(data[_PYC_HEADER.size:])
+        except (EOFError, ValueError, TypeError):
+            return None
+
+    def set_code(self, url, source, code):
+        """Cache code compiled from source for url."""
+        header = _PYC_HEADER.pack(importlib.util.MAGIC_NUMBER, _PYC_FLAGS,
+                                  importlib.util.source_hash(source))
+        try:
+            self._write(self._path(url, '.pyc'), header + marshal.dumps(code))
+        except OSError as e:
+            log.debug('cache: could not write code of %r. %s', url, e)
+
+
+_url_cache = None
+
+
+def install_cache(directory=None, max_age=0):
+    """Cache remote files and compiled code on disk, see UrlCache.
+
+    :return: UrlCache
+    """
+    global _url_cache
+    _url_cache = UrlCache(directory, max_age)
+    log.debug('%r installed', _url_cache)
+    return _url_cache
+
+
+def remove_cache():
+    global _url_cache
+    _url_cache = None
+
+
+class ImportProfile:
+    """Where the time of remote imports goes, like python -X importtime.
+
+    Every remote module gets the time its lookup, the fetch of its source,
+    its compilation and its execution took. Time spent importing other
+    modules meanwhile, e.g. by a package importing its submodules, is left
+    to those, as -X importtime does; cumulative includes it. Every URL
+    gets the number and time of its requests, the bytes transferred and
+    how the on-disk cache answered it the last time.
+    """
+    PHASES = ('find', 'fetch', 'compile', 'exec')
+
+    def __init__(self):
+        self.modules = {}
+        self.urls = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _module(self, fullname):
+        if fullname not in self.modules:
+            with self._lock:
+                self.modules.setdefault(fullname, dict.fromkeys(
+                    self.PHASES + ('cumulative',), 0.0))
+        return self.modules[fullname]
+
+    @contextlib.contextmanager
+    def timing(self, fullname, phase):
+        """Time a phase of importing fullname, one of PHASES."""
+        try:
+            stack = self._local.stack
+        except AttributeError:
+            stack = self._local.stack = []
+        # Phases started meanwhile, of this or other modules, and how long
+        # they took, are left out of this one.
+        stack.append([fullname, 0.0])
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            nested = stack.pop()[1]
+            if stack:
+                stack[-1][1] += elapsed
+            record = self._module(fullname)
+            record[phase] += elapsed - nested
+            # Only the outermost phase of a module counts towards its
+            # cumulative time, with all others nested in it.
+            if all(name != fullname for name, _ in stack):
+                record['cumulative'] += elapsed
+
+    def fetched(self, url, seconds, transferred, cache):
+        """Record a request of url.
+
+        :param transferred: bytes of the body received from the network,
+            i.e. compressed if it was sent gzip encoded
+        :param cache: how the request was answered, e.g. 'hit' or 'miss'
+        """
+        with self._lock:
+            record = self.urls.setdefault(url, {
+                'requests': 0, 'seconds': 0.0, 'bytes': 0, 'cache': None})
+            record['requests'] += 1
+            record['seconds'] += seconds
+            record['bytes'] += transferred
+            record['cache'] = cache
+
+    def snapshot(self):
+        """Return the modules and URLs recorded, as plain dicts.
+
+        The modules include the bytes and cache answer of their source,
+        under the URL it was fetched from.
+        """
+        with self._lock:
+            modules = {name: dict(record)
+                       for name, record in self.modules.items()}
+            urls = {url: dict(record) for url, record in self.urls.items()}
+        for record in modules.values():
+            source = urls.get(record.get('url'), {})
+            record['bytes'] = source.get('bytes', 0)
+            record['cache'] = source.get('cache')
+        return {'modules': modules, 'urls': urls}
+
+    def report(self, sort='cumulative', limit=None, urls=False):
+        """Return a table of the modules imported, worst first.
+
+        :param sort: column to sort by: a phase, 'cumulative' or 'bytes',
+            or None to keep the order of import
+        :param limit: number of modules to list, all by default
+        :param urls: also list the URLs requested
+        """
+        snapshot = self.snapshot()
+        modules = list(snapshot['modules'].items())
+        if sort is not None:
+            modules.sort(key=lambda item: item[1][sort], reverse=True)
+        lines = ['urlimport: %10s | %10s | %10s | %10s | %10s | %9s | %-11s | '
+                 'module' % ('find [us]', 'fetch [us]', 'comp [us]',
+                             'exec [us]', 'cumul [us]', 'bytes', 'cache')]
+        for name, record in modules[:limit]:
+            lines.append('urlimport: %10d | %10d | %10d | %10d | %10d | %9d | '
+                         '%-11s | %s' % (
+                             record['find'] * 1e6, record['fetch'] * 1e6,
+                             record['compile'] * 1e6, record['exec'] * 1e6,
+                             record['cumulative'] * 1e6, record['bytes'],
+                             record['cache'] or '-', name))
+        if urls:
+            lines.append('urlimport: %8s | %10s | %9s | %-11s | url'
+                         % ('requests', 'time [us]', 'bytes', 'cache'))
+            for url, record in sorted(snapshot['urls'].items(),
+                                      key=lambda item: item[1]['seconds'],
+                                      reverse=True):
+                lines.append('urlimport: %8d | %10d | %9d | %-11s | %s' % (
+                    record['requests'], record['seconds'] * 1e6,
+                    record['bytes'], record['cache'] or '-', url))
+        return '\n'.join(lines)
+
+    def print_report(self, file=None, **kwargs):
+        print(self.report(**kwargs), file=sys.stderr if file is None else file)
+
+
+_profile = None
+
+
+def install_profile(report_at_exit=False):
+    """Record the timings of remote imports, see ImportProfile.
+
+    :param report_at_exit: print the report to stderr when exiting
+    :return: ImportProfile
+    """
+    global _profile
+    _profile = ImportProfile()
+    if report_at_exit:
+        atexit.register(_profile.print_report, urls=True)
+    log.debug('%r installed', _profile)
+    return _profile
+
+
+def remove_profile():
+    global _profile
+    _profile = None
+
+
+def _timed(phase):
+    """Time a method, taking a module's full name, as a phase of its import."""
+    def decorate(method):
+        @functools.wraps(method)
+        def timed(self, fullname, *args, **kwargs):
+            if _profile is None:
+                return method(self, fullname, *args, **kwargs)
+            with _profile.timing(fullname, phase):
+                return method(self, fullname, *args, **kwargs)
+        return timed
+    return decorate
+
+
+_lazy = False
+_warm_up = None
+
+
+def _warm_up_loop(queue):
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        loader, fullname = item
+        try:
+            loader.warm_up(fullname)
+        except ImportError as e:
+            log.debug('warm up: %r failed. %s', fullname, e)
+
+
+def install_lazy(warm_up=False):
+    """Load remote modules lazily, like importlib.util.LazyLoader.
+
+    Importing a module creates it without fetching it; its source is only
+    fetched, compiled and run when one of its attributes is first used.
+    The same goes for packages, with or without a manifest, except that
+    importing one of their submodules uses them.
+
+    :param warm_up: fetch and compile the modules found in a background
+        thread, one at a time, so that first use only has to run them
+    """
+    global _lazy, _warm_up
+    remove_lazy()
+    _lazy = True
+    if warm_up:
+        _warm_up = Queue()
+        threading.Thread(target=_warm_up_loop, args=(_warm_up,),
+                         name='urlwarmup', daemon=True).start()
+    log.debug('lazy loading installed')
+
+
+def remove_lazy():
+    global _lazy, _warm_up
+    _lazy = False
+    if _warm_up is not None:
+        _warm_up.put(None)
+        _warm_up = None
+
+
+def _spec_from_loader(fullname, loader):
+    """Return the ModuleSpec of fullname, lazily loaded if installed."""
+    spec = importlib.util.spec_from_loader(fullname, loader)
+    if _lazy:
+        spec.loader = importlib.util.LazyLoader(loader)
+        if _warm_up is not None:
+            _warm_up.put((loader, fullname))
+    return spec
+
+
+class ConnectionPool:
+    """HTTP/1.1 connections kept alive, shared by all finders and loaders.
+
+    urlopen() connects anew for every file, which for small modules costs
+    more than the transfer. Idle connections are kept per server, and at
+    most max_connections are open to one server at a time; further
+    requests wait for one to become idle. Responses are asked for gzip
+    compressed, and decompressed transparently; the length of the body as
+    received is kept as the response's transferred attribute.
+
+    Requests to servers that urllib would reach through a proxy, as
+    configured by the environment (see urllib.request.getproxies()), are
+    handed to urllib.request.urlopen() instead. Like urllib's default
+    opener, the proxies are read once, when the pool is created. Other
+    requests bypass urllib's openers, including one installed with
+    urllib.request.install_opener(), hence the pool is only used once
+    installed with install_pool().
+    """
+    redirects = 5
+
+    def __init__(self, max_connections=4, timeout=30, gzip=True):
+        """Initialize instance.
+
+        :param max_connections: connections open per server at most
+        :param timeout: seconds to wait for a server
+        :param gzip: ask for gzip compressed responses
+        """
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.gzip = gzip
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+        self._proxies = getproxies()
+        self._proxied = {}
+        # Counters, for benchmarks and the curious.
+        self.connects = 0
+        self.requests = 0
+
+    def _acquire(self, key):
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(
+                    self.max_connections)
+                self._idle[key] = []
+            slots = self._slots[key]
+        slots.acquire()
+        with self._lock:
+            if self._idle[key]:
+                return self._idle[key].pop(), True
+            self.connects += 1
+        scheme, netloc = key
+        if scheme == 'https':
+            return HTTPSConnection(netloc, timeout=self.timeout), False
+        return HTTPConnection(netloc, timeout=self.timeout), False
+
+    def _release(self, key, connection, reuse):
+        if reuse:
+            with self._lock:
+                self._idle[key].append(connection)
+        else:
+            connection.close()
+        self._slots[key].release()
+
+    def _request(self, url, headers):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        connection, reused = self._acquire(key)
+        try:
+            while True:
+                try:
+                    connection.request('GET', path, headers=headers)
+                    response = connection.getresponse()
+                    body = response.read()
+                    break
+                except (HTTPException, OSError) as e:
+                    connection.close()
+                    # The server may have closed an idle connection
+                    # meanwhile, so retry those on a new one.
+                    if not reused:
+                        raise URLError(e)
+                    reused = False
+                    with self._lock:
+                        self.connects += 1
+        except BaseException:
+            self._release(key, connection, False)
+            raise
+        with self._lock:
+            self.requests += 1
+        self._release(key, connection, not response.will_close)
+        return response, body
+
+    def urlopen(self, request):
+        """Open request like urllib.request.urlopen, on a pooled connection.
+
+        :param request: URL or Request
+        :return: response, with the length of the body before decoding as
+            its transferred attribute
+        :raises HTTPError, URLError: if request could not be fetched
+        """
+        if isinstance(request, str):
+            request = Request(request)
+        url = request.full_url
+        if self._uses_proxy(url):
+            return urlopen(request)
+        headers = dict(request.header_items())
+        # Ranges apply to the encoded body, which then is not a zip.
+        if self.gzip and 'Range' not in headers:
+            headers['Accept-Encoding'] = 'gzip'
+        for _ in range(self.redirects + 1):
+            response, body = self._request(url, headers)
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url = urljoin(url, location)
+                continue
+            if response.status >= 300:
+                raise HTTPError(url, response.status, response.reason,
+                                response.headers, None)
+            transferred = len(body)
+            if response.getheader('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            result = addinfourl(io.BytesIO(body), response.headers, url,
+                                response.status)
+            result.transferred = transferred
+            return result
+        raise HTTPError(url, response.status, 'Too many redirects',
+                        response.headers, None)
+
+    def _uses_proxy(self, url):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        proxied = self._proxied.get(key)
+        if proxied is None:
+            proxied = self._proxied[key] = (
+                parts.scheme in self._proxies and
+                not proxy_bypass(parts.hostname or ''))
+        return proxied
+
+    def close(self):
+        """Close the idle connections."""
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+                del connections[:]
+
+
+_pool = None
+
+
+@atexit.register
+def _close_pool():
+    if _pool is not None:
+        _pool.close()
+
+
+def install_pool(max_connections=4, timeout=30, gzip=True):
+    """Fetch through a new ConnectionPool, see its arguments.
+
+    The pool does not go through urllib's openers, so handlers installed
+    with urllib.request.install_opener() no longer apply.
+
+    :return: ConnectionPool
+    """
+    global _pool
+    remove_pool()
+    _pool = ConnectionPool(max_connections, timeout, gzip)
+    log.debug('%r installed', _pool)
+    return _pool
+
+
+def remove_pool():
+    """Fetch with urllib.request.urlopen again, a connection per request."""
+    global _pool
+    _close_pool()
+    _pool = None
+
+
+def _urlopen(request):
+    """Open request on a pooled connection if there is a pool."""
+    if _pool is not None:
+        return _pool.urlopen(request)
+    return urlopen(request)
+
+
+#: Bodies downloaded by prefetch() that no finder or loader asked for yet.
+_prefetched = {}
+#: Addresses prefetch() crawled, with everything below them.
+_prefetched_trees = set()
+
+
+def _transferred(response, data):
+    """Return how many bytes of the body of response came over the network."""
+    # Only pooled responses are decoded, and they tell the length received.
+    return getattr(response, 'transferred', len(data))
+
+
+def _fetch(url, opener=_urlopen):
+    """Return the body of url, through the on-disk cache if installed."""
+    started = time.perf_counter()
+    try:
+        if url in _prefetched:
+            data, cache, transferred = _prefetched.pop(url), 'prefetched', 0
+        elif _url_cache is not None:
+            data, cache, transferred = _url_cache._fetch(
+                url, opener, _manifest_digests.get(url))
+        else:
+            response = opener(url)
+            data, cache = response.read(), 'uncached'
+            transferred = _transferred(response, data)
+    except (HTTPError, URLError):
+        if _profile is not None:
+            _profile.fetched(url, time.perf_counter() - started, 0, 'failed')
+        raise
+    if _profile is not None:
+        _profile.fetched(url, time.perf_counter() - started, transferred,
+                         cache)
+    return data
+
+
+def prefetch(url, workers=8):
+    """Download the package tree at url concurrently, ahead of its imports.
+
+    Directory listings are crawled breadth first, and every listing and
+    module found is fetched by a pool of threads, over the connection
+    pool when installed. The bodies are kept until the finders and loaders
+    ask for them, so the imports that follow make no requests of their
+    own.
+
+    :param url: address of a package, or of a directory of packages
+    :param workers: number of concurrent downloads, further bounded by
+        the connections the connection pool, if installed, opens to a
+        server
+    :return: number of files fetched
+    """
+    url = url.rstrip('/')
+    fetched = {}
+
+    def fetch(url):
+        try:
+            return _fetch(url)
+        except (HTTPError, URLError) as e:
+            log.debug('prefetch: %r failed. %s', url, e)
+
+    started = time.perf_counter()
+    manifest = _get_manifest(url)
+    with ThreadPoolExecutor(workers, thread_name_prefix='urlprefetch') as pool:
+        if manifest is None:
+            pending = {pool.submit(fetch, url): (url, True)}
+        else:
+            # The manifest lists every module already, nothing to crawl.
+            pending = {pool.submit(fetch, filename): (filename, False)
+                       for filename in manifest.filenames(url)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                address, listing = pending.pop(future)
+                body = future.result()
+                if body is None:
+                    continue
+                fetched[address] = body
+                if not listing:
+                    continue
+                parser = _LinkParser()
+                try:
+                    parser.feed(body.decode('utf-8'))
+                except UnicodeDecodeError:
+                    continue
+                for link in parser.links:
+                    name, ext = os.path.splitext(link)
+                    child = address + '/' + link
+                    if child in fetched or not name.isidentifier():
+                        continue
+                    if ext in ('', '.py'):
+                        pending[pool.submit(fetch, child)] = (child, not ext)
+    _prefetched.update(fetched)
+    _prefetched_trees.add(url)
+    log.debug('prefetch: %d files from %r in %.3fs', len(fetched), url,
+              time.perf_counter() - started)
+    return len(fetched)
+
+
+class _LinkParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.links = set()
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            href = dict(attrs).get('href')
+            if href:
+                self.links.add(href.rstrip('/'))
+
+
+#: Name of the manifest file at the root of a remote tree.
+MANIFEST = 'urlimport.json'
+#: Manifests by the URL of their tree, None where there is none.
+_manifests = {}
+#: SHA-256 hex digests of remote files, as listed in their manifest.
+_manifest_digests = {}
+
+
+class UrlManifest:
+    """Index of every module below a base URL.
+
+    A manifest is a JSON file named MANIFEST at the base URL, mapping the
+    full name of each module and package to its path relative to the base
+    URL and the SHA-256 of its source, see make_manifest():
+
+    {"modules": {"pkg": {"path": "pkg/__init__.py", "sha256": "..."},
+                 "pkg.mod": {"path": "pkg/mod.py", "sha256": "..."}}}
+
+    Finders answer find_spec() from it, without any further requests, and
+    the on-disk cache uses cached files whose digest matches without
+    revalidating them.
+    """
+    def __init__(self, baseurl, data):
+        """Initialize instance.
+
+        :param baseurl: URL the paths in data are relative to
+        :param data: decoded manifest
+        """
+        self.baseurl = baseurl
+        self.modules = data['modules']
+        for entry in self.modules.values():
+            if entry.get('sha256'):
+                _manifest_digests[baseurl + '/' + entry['path']] = \
+                    entry['sha256']
+
+    def filenames(self, url=None):
+        """Return the URLs of all modules, or of those below url."""
+        filenames = [self.baseurl + '/' + entry['path']
+                     for entry in self.modules.values()]
+        if url is None or url == self.baseurl:
+            return filenames
+        return [filename for filename in filenames
+                if filename.startswith(url + '/')]
+
+    def find_spec(self, fullname, location=None):
+        """Return the ModuleSpec of fullname, or None if it is not listed.
+
+        :param location: only find modules directly below this URL
+        """
+        entry = self.modules.get(fullname)
+        if entry is None:
+            return None
+        filename = self.baseurl + '/' + entry['path']
+        dirname, basename = filename.rsplit('/', 1)
+        if basename == '__init__.py':
+            loader = UrlPackageLoader(dirname)
+            parent = dirname.rsplit('/', 1)[0]
+        else:
+            loader = UrlModuleLoader(dirname)
+            parent = dirname
+        if location is not None and parent != location:
+            return None
+        return _spec_from_loader(fullname, loader)
+
+
+def _get_manifest(url):
+    """Return the manifest covering url, or None.
+
+    Only the manifest at url itself is ever requested, and only once;
+    addresses below a tree that was looked up already share its answer.
+    """
+    for tree, manifest in _manifests.items():
+        if url.startswith(tree + '/'):
+            return manifest
+    if url not in _manifests:
+        try:
+            data = json.loads(_fetch(url + '/' + MANIFEST).decode('utf-8'))
+            _manifests[url] = UrlManifest(url, data)
+            log.debug('manifest: %d modules below %r', len(data['modules']),
+                      url)
+        except (HTTPError, URLError, ValueError, KeyError) as e:
+            log.debug('manifest: none at %r. %s', url, e)
+            _manifests[url] = None
+    return _manifests[url]
+
+
+def make_manifest(directory, filename=MANIFEST):
+    """Write the manifest of the modules below a directory to serve.
+
+    :param directory: local directory published as the base URL
+    :param filename: name of the manifest, relative to directory
+    :return: the manifest written, as a dict
+    """
+    modules = {}
+    for root, dirs, files in os.walk(directory):
+        relative = os.path.relpath(root, directory)
+        parts = [] if relative == '.' else relative.split(os.sep)
+        dirs[:] = sorted(name for name in dirs if name.isidentifier())
+        for name in sorted(files):
+            stem, ext = os.path.splitext(name)
+            if ext != '.py' or not stem.isidentifier():
+                continue
+            if stem == '__init__':
+                if not parts:
+                    continue
+                fullname = '.'.join(parts)
+            else:
+                fullname = '.'.join(parts + [stem])
+            with open(os.path.join(root, name), 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            modules[fullname] = {'path': '/'.join(parts + [name]),
+                                 'sha256': digest}
+    manifest = {'modules': modules}
+    with open(os.path.join(directory, filename), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    return manifest
+
+
 # Get links from a given URL
 def _get_links(url):
-    class LinkParser(url):
-        def handle_starttag(self, tag, attrs):
-            if tag == 'a':
-                attrs = dict(attrs)
-                links.add(attrs.get('href').rstrip('/'))
-
-    links = set()
+    parser = _LinkParser()
     try:
         log.debug('Getting links form %s' % url)
-        u = urlopen(url)
-        parser = LinkParser()
-        parser.feed(u.read().decode('utf-8'))
+        parser.feed(_fetch(url).decode('utf-8'))
     except Exception as e:
         log.debug('Could not get Links. %s' % e)
-    log.debug('links: %r', links)
-    return links
+    log.debug('links: %r', parser.links)
+    return parser.links
 
 
 class UrlMetaFinder(importlib.abc.MetaPathFinder):
@@ -58,8 +891,20 @@ class UrlMetaFinder(importlib.abc.MetaPathFinder):
         self._links = {}
         self._loaders = { baseurl: UrlModuleLoader(baseurl)}
 
+    @_timed('find')
+    def find_spec(self, fullname, path=None, target=None):
+        if path and not path[0].startswith(self._baseurl):
+            return None
+        manifest = _get_manifest(self._baseurl)
+        if manifest is not None:
+            return manifest.find_spec(fullname)
+        loader = self.find_module(fullname, path)
+        if loader is None:
+            return None
+        return _spec_from_loader(fullname, loader)
+
     def find_module(self, fullname, path=None):
-        log.debug('find_module: fullname=%r, basename=%r', baseurl, basename)
+        log.debug('find_module: fullname=%r, path=%r', fullname, path)
         if path is None:
             baseurl = self._baseurl
         else:
@@ -72,29 +917,29 @@ class UrlMetaFinder(importlib.abc.MetaPathFinder):
         log.debug('find_module: baseurl=%r, basename=%r', baseurl, basename)
 
         # Check link cache
-        if basename not in self.links:
+        if baseurl not in self._links:
             self._links[baseurl] = _get_links(baseurl)
 
-        # Check if it's a package
+        # Check if it's a package, from its listing; the import system
+        # loads it, so it runs once, and lazily if installed.
         if basename in self._links[baseurl]:
             log.debug('find_module: trying package %r', fullname)
-            fullurl = self._baseurl + '/' + basename
-            # Attempt to load the package (which accesses __init__py)
-            loader = UrlPackageLoader(fullurl)
-            try:
-                loader.load_module(fullname)
+            fullurl = baseurl + '/' + basename
+            if fullurl not in self._links:
                 self._links[fullurl] = _get_links(fullurl)
-                self._loaders[fullurl] = UrlModuleLoader(fullurl)
-                log.debug('find_module: package %r loaded', fullname)
-            except ImportError as e:
-                log.debug('find_module: package import failed. %s', e)
-                loader = None
-            return loader
+            if '__init__.py' not in self._links[fullurl]:
+                log.debug('find_module: %r has no __init__.py', fullname)
+                return None
+            self._loaders.setdefault(fullurl, UrlModuleLoader(fullurl))
+            log.debug('find_module: package %r found', fullname)
+            return UrlPackageLoader(fullurl)
 
         # A normal module
         filename = basename + '.py'
         if filename in self._links[baseurl]:
             log.debug('find_module: module %r found', fullname)
+            if baseurl not in self._loaders:
+                self._loaders[baseurl] = UrlModuleLoader(baseurl)
             return self._loaders[baseurl]
         else:
             log.debug('find_module: module %r not found', fullname)
@@ -103,6 +948,7 @@ class UrlMetaFinder(importlib.abc.MetaPathFinder):
     def invalidate_caches(self):
         log.debug('invalidating link cache')
         self._links.clear()
+        _manifests.clear()
 
 
 # Module Loader for a URL
@@ -110,6 +956,8 @@ class UrlModuleLoader(importlib.abc.SourceLoader):
     def __init__(self, baseurl):
         self._baseurl = baseurl
         self._source_cache = {}
+        self._code_cache = {}
+        self._lock = threading.Lock()
 
     def module_repr(self, module):
         return '<urlmodule %r from %r>' % (module.__name__, module.__file__)
@@ -117,39 +965,72 @@ class UrlModuleLoader(importlib.abc.SourceLoader):
     # Required method
     def load_module(self, fullname):
         code = self.get_code(fullname)
-        mod = sys.modules.setdefault(fullname, imp.new_module(fullname))
+        mod = sys.modules.setdefault(fullname, types.ModuleType(fullname))
         mod.__file__ = self.get_filename(fullname)
         mod.__loader__ = self
-        mod.__package__ = fullname.rpartition('.')[0]
-        exec(code, mod.__dict__)
+        if self.is_package(fullname):
+            mod.__path__ = [self._baseurl]
+            mod.__package__ = fullname
+        else:
+            mod.__package__ = fullname.rpartition('.')[0]
+        self._exec(fullname, code, mod)
         return mod
 
+    def exec_module(self, module):
+        self._exec(module.__name__, self.get_code(module.__name__), module)
+
+    @_timed('exec')
+    def _exec(self, fullname, code, module):
+        exec(code, module.__dict__)
+
     # Optional extensions
+    @_timed('compile')
     def get_code(self, fullname):
+        if fullname in self._code_cache:
+            return self._code_cache.pop(fullname)
+        filename = self.get_filename(fullname)
         src = self.get_source(fullname)
-        return compile(src, self.get_filename(fullname), 'exec')
+        if _url_cache is None:
+            return compile(src, filename, 'exec')
+        source = src.encode('utf-8')
+        code = _url_cache.get_code(filename, source)
+        if code is None:
+            code = compile(src, filename, 'exec')
+            _url_cache.set_code(filename, source, code)
+        else:
+            log.debug('loader: cached code of %r', filename)
+        return code
 
     def get_data(self, path):
         pass
 
+    def warm_up(self, fullname):
+        """Fetch and compile fullname now, ahead of running it."""
+        if fullname not in self._code_cache:
+            self._code_cache[fullname] = self.get_code(fullname)
+
     def get_filename(self, fullname):
         return self._baseurl + '/' + fullname.split('.')[-1] + '.py'
 
+    @_timed('fetch')
     def get_source(self, fullname):
         filename = self.get_filename(fullname)
-        log.debug('loader: %r loaded', filename)
-        if filename in self._source_cache:
-            log.debug('loader: cached %r', filename)
-            return self._source_cache[filename]
-        try:
-            u = urlopen(filename)
-            source = u.read().decode('utf-8')
-            log.debug('loader: %r loaded', filename)
-            self._source_cache[filename] = source
-            return source
-        except (HTTPError, URLError) as e:
-            log.debug('loader: %r failed. %s', filename, e)
-            raise ImportError('Can\'t load %s' % filename)
+        if _profile is not None:
+            _profile._module(fullname)['url'] = filename
+        log.debug('loader: loading %r', filename)
+        # Warming up may be fetching the same file.
+        with self._lock:
+            if filename in self._source_cache:
+                log.debug('loader: cached %r', filename)
+                return self._source_cache[filename]
+            try:
+                source = _fetch(filename).decode('utf-8')
+                log.debug('loader: %r loaded', filename)
+                self._source_cache[filename] = source
+                return source
+            except (HTTPError, URLError) as e:
+                log.debug('loader: %r failed. %s', filename, e)
+                raise ImportError('Can\'t load %s' % filename)
 
     def is_package(self, fullname):
         return False
@@ -157,11 +1038,6 @@ class UrlModuleLoader(importlib.abc.SourceLoader):
 
 # Package loader for a URL
 class UrlPackageLoader(UrlModuleLoader):
-    def load_module(self, fullname):
-        mod = super().load_module(fullname)
-        mod.__path__ = [self._baseurl]
-        mod.__package__ = fullname
-
     def get_filename(self, fullname):
         return self._baseurl + '/' + '__init__.py'
 
@@ -181,7 +1057,7 @@ def install_meta(address):
 
 def remove_meta(address):
     if address in _installed_meta_cache:
-        finder = _installed_meta_cache(address)
+        finder = _installed_meta_cache.pop(address)
         sys.meta_path.remove(finder)
         log.debug('%r removed from sys.meta_path', finder)
 
@@ -193,6 +1069,20 @@ class UrlPathFinder(importlib.abc.PathEntryFinder):
         self._loader = UrlModuleLoader(baseurl)
         self._baseurl = baseurl
 
+    @_timed('find')
+    def find_spec(self, fullname, target=None):
+        manifest = _get_manifest(self._baseurl)
+        if manifest is not None:
+            return manifest.find_spec(fullname, self._baseurl)
+        loader, portions = self.find_loader(fullname)
+        if loader is not None:
+            return _spec_from_loader(fullname, loader)
+        if portions:
+            spec = importlib.machinery.ModuleSpec(fullname, None)
+            spec.submodule_search_locations = portions
+            return spec
+        return None
+
     def find_loader(self, fullname):
         log.debug('find_loader: %r', fullname)
         parts = fullname.split('.')
@@ -202,19 +1092,22 @@ class UrlPathFinder(importlib.abc.PathEntryFinder):
             self._links = []
             self._links = _get_links(self._baseurl)
 
-        # Check if it's a package
+        # Check if it's a package, from its listing; the import system
+        # loads it, so it runs once, and lazily if installed.
         if basename in self._links:
             log.debug('find_loader: trying package %r', fullname)
             fullurl = self._baseurl + '/' + basename
-            # Attempt to load the package (which accesses __init__.py)
-            loader = UrlPackageLoader(fullurl)
-            try:
-                loader.load_module(fullname)
-                log.debug('find_loader: package %r loaded')
-            except ImportError as e:
+            # Hand the listing on to the package's own finder.
+            finder = _url_path_cache.get(fullurl)
+            if finder is None:
+                finder = _url_path_cache[fullurl] = UrlPathFinder(fullurl)
+            if finder._links is None:
+                finder._links = _get_links(fullurl)
+            if '__init__.py' not in finder._links:
                 log.debug('find_loader: %r is a namespace package', fullname)
-                loader = None
-            return (loader, [fullurl])
+                return (None, [fullurl])
+            log.debug('find_loader: package %r found', fullname)
+            return (UrlPackageLoader(fullurl), [fullurl])
 
         # A normal module
         filename = basename + '.py'
@@ -228,16 +1121,218 @@ class UrlPathFinder(importlib.abc.PathEntryFinder):
     def invalidate_caches(self):
         log.debug('invalidating link cache')
         self._links = None
+        _manifests.clear()
+
+
+class _RangeFile:
+    """Read-only file of a remote archive, read with HTTP Range requests.
+
+    Reads are served from blocks of at least block_size bytes, so that
+    zipfile's small reads of headers and members cost one request each
+    at most. Servers ignoring Range send the whole file at once, which is
+    then served from memory.
+    """
+    block_size = 64 * 1024
+
+    def __init__(self, url, opener=_urlopen):
+        """Initialize instance.
+
+        :param url: URL of the file
+        :param opener: function opening a Request, like urlopen
+        """
+        self.url = url
+        self._opener = opener
+        self._lock = threading.Lock()
+        self._blocks = []
+        self._pos = 0
+        # The end of the file holds the central directory of a zip.
+        self.size = self._get('bytes=-%d' % self.block_size)
+        self.requests = 1
+
+    def _get(self, byte_range):
+        started = time.perf_counter()
+        response = self._opener(Request(self.url,
+                                        headers={'Range': byte_range}))
+        data = response.read()
+        if _profile is not None:
+            _profile.fetched(self.url, time.perf_counter() - started,
+                             len(data), 'range')
+        content_range = response.headers.get('Content-Range')
+        if response.status == 206 and content_range:
+            match = re.match(r'bytes (\d+)-\d+/(\d+)', content_range)
+            start, size = int(match.group(1)), int(match.group(2))
+        else:
+            start, size = 0, len(data)
+        self._blocks.append((start, data))
+        return size
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self._pos = offset
+        return offset
+
+    def tell(self):
+        return self._pos
+
+    def read(self, n=-1):
+        start = self._pos
+        end = self.size if n is None or n < 0 else min(start + n, self.size)
+        if end <= start:
+            return b''
+        with self._lock:
+            for block_start, block in self._blocks:
+                if block_start <= start and end <= block_start + len(block):
+                    break
+            else:
+                last = min(max(end, start + self.block_size), self.size)
+                self._get('bytes=%d-%d' % (start, last - 1))
+                self.requests += 1
+                block_start, block = self._blocks[-1]
+        self._pos = end
+        return block[start - block_start:end - block_start]
+
+    def close(self):
+        self._blocks = []
+
+
+class _MappedFile(mmap.mmap):
+    # zipfile wants to know, mmap does not tell.
+    def seekable(self):
+        return True
+
+
+class UrlArchive:
+    """Zip archive or wheel at a URL, to import modules and data from.
+
+    Only the members asked for are transferred, with Range requests,
+    unless download is set; the archive is then downloaded once, through
+    the on-disk cache if installed, and read from a memory map of a
+    temporary file.
+    """
+    def __init__(self, url, download=False):
+        """Initialize instance.
+
+        :param url: URL of the archive
+        :param download: download the whole archive rather than members
+        :raises zipfile.BadZipFile: if url is no zip archive
+        :raises HTTPError, URLError: if url could not be fetched
+        """
+        self.url = url
+        if download:
+            data = _fetch(url)
+            with tempfile.TemporaryFile() as f:
+                f.write(data)
+                f.flush()
+                self._file = _MappedFile(f.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+        else:
+            self._file = _RangeFile(url)
+        self._zip = zipfile.ZipFile(self._file)
+        self.names = set(self._zip.namelist())
+        log.debug('archive: %d members in %r', len(self.names), url)
+
+    def read(self, name):
+        """Return the contents of member name.
+
+        :raises KeyError: if there is no such member
+        """
+        return self._zip.read(name)
+
+    def close(self):
+        self._zip.close()
+        self._file.close()
+
+
+# Module loader for a member of a remote archive
+class UrlArchiveLoader(UrlModuleLoader):
+    def __init__(self, archive, member):
+        self._archive = archive
+        self._member = member
+        super().__init__(self.get_filename(None).rpartition('/')[0])
+
+    def get_data(self, path):
+        prefix = self._archive.url + '/'
+        try:
+            if path.startswith(prefix):
+                return self._archive.read(path[len(prefix):])
+        except KeyError:
+            pass
+        raise FileNotFoundError(path)
+
+    def get_filename(self, fullname):
+        return self._archive.url + '/' + self._member
+
+    @_timed('fetch')
+    def get_source(self, fullname):
+        filename = self.get_filename(fullname)
+        try:
+            return importlib.util.decode_source(self.get_data(filename))
+        except OSError as e:
+            raise ImportError('Can\'t load %s' % filename) from e
+
+    def is_package(self, fullname):
+        return self._member.endswith('/__init__.py')
+
+
+# Path finder for a directory of a remote archive
+class UrlArchiveFinder(importlib.abc.PathEntryFinder):
+    def __init__(self, archive, prefix=''):
+        self._archive = archive
+        self._prefix = prefix
+
+    @_timed('find')
+    def find_spec(self, fullname, target=None):
+        name = self._prefix + fullname.rpartition('.')[2]
+        for member in (name + '/__init__.py', name + '.py'):
+            if member in self._archive.names:
+                log.debug('find_spec: %r found in %r', fullname,
+                          self._archive.url)
+                loader = UrlArchiveLoader(self._archive, member)
+                return _spec_from_loader(fullname, loader)
+        return None
+
+    def invalidate_caches(self):
+        pass
+
+
+_ARCHIVE_PATH = re.compile(r'^(.+?\.(?:zip|whl))(?:/(.*))?$')
+_archives = {}
+_download_archives = False
+def _handle_archive(path):
+    archive_url, prefix = _ARCHIVE_PATH.match(path).groups()
+    if archive_url not in _archives:
+        try:
+            _archives[archive_url] = UrlArchive(archive_url,
+                                                _download_archives)
+        except (HTTPError, URLError, zipfile.BadZipFile) as e:
+            log.debug('Could not open archive %s. %s', archive_url, e)
+            return None
+    prefix = prefix.strip('/') + '/' if prefix else ''
+    return UrlArchiveFinder(_archives[archive_url], prefix)
 
 
 # Check path to see if it looks like a url
 _url_path_cache = {}
+_prefetch_paths = False
 def handle_url(path):
     if path.startswith(('http://', 'https://')):
         log.debug('Handle path? %s. [Yes]', path)
         if path in _url_path_cache:
             finder = _url_path_cache[path]
+        elif _ARCHIVE_PATH.match(path):
+            finder = _handle_archive(path)
+            _url_path_cache[path] = finder
         else:
+            if _prefetch_paths and not any(
+                    path == tree or path.startswith(tree + '/')
+                    for tree in _prefetched_trees):
+                prefetch(path)
             finder = UrlPathFinder(path)
             _url_path_cache[path] = finder
         return finder
@@ -245,7 +1340,17 @@ def handle_url(path):
         log.debug('Handle path? %s. [No]', path)
 
 
-def install_path_hook():
+def install_path_hook(prefetch=False, download_archives=False):
+    """Import from http and https addresses on sys.path.
+
+    :param prefetch: download each address' tree concurrently before the
+        first import from it, see prefetch()
+    :param download_archives: download zip archives and wheels on sys.path
+        whole, rather than their members with Range requests
+    """
+    global _prefetch_paths, _download_archives
+    _prefetch_paths = prefetch
+    _download_archives = download_archives
     sys.path_hooks.append(handle_url)
     sys.path_importer_cache.clear()
     log.debug('Installing handle_url')
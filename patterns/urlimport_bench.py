@@ -0,0 +1,226 @@
+"""Benchmarks for patterns.urlimport.
+
+Usage:
+
+>python urlimport_bench.py --packages 4 --modules 25 --connect-latency 20
+
+Imports a generated tree of remote packages from a local test server,
+once with a new urlopen() connection per request and once over the
+connection pool, with and without gzip, both importing module by module
+and after a concurrent prefetch. The server stands in for a remote one:
+--connect-latency delays each new connection, as a TCP and TLS handshake
+over a long distance would, and --latency each request.
+
+Results can be saved as JSON:
+
+>python urlimport_bench.py --max-connections 1 4 8 --json out.json
+
+"""
+# Import Built-ins
+import argparse
+import functools
+import gzip
+import json
+import multiprocessing as mp
+import os
+import platform
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+# Import Homebrew
+import urlimport
+
+
+class _Handler(SimpleHTTPRequestHandler):
+    """Serves a directory like a remote server, counting what it does."""
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written apart; like real servers, do not wait
+    # for the client to acknowledge the headers first.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.count('connections')
+        time.sleep(self.server.connect_latency)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        self.server.count('requests')
+        time.sleep(self.server.latency)
+        path = self.translate_path(self.path)
+        if (not self.server.gzip or not os.path.isfile(path)
+                or 'gzip' not in self.headers.get('Accept-Encoding', '')):
+            return super().send_head()
+        with open(path, 'rb') as f:
+            body = gzip.compress(f.read())
+        self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.server.count('bytes', len(body))
+        self.wfile.write(body)
+        return None
+
+    def copyfile(self, source, outputfile):
+        data = source.read()
+        self.server.count('bytes', len(data))
+        outputfile.write(data)
+
+
+class TestServer(ThreadingHTTPServer):
+    """Local HTTP server with the latencies of a remote one.
+
+    Counts the connections accepted, the requests served and the bytes of
+    the bodies sent.
+    """
+    daemon_threads = True
+
+    def __init__(self, directory, connect_latency=0.0, latency=0.0,
+                 gzip=True):
+        """Initialize instance.
+
+        :param directory: directory to serve
+        :param connect_latency: seconds each new connection is delayed
+        :param latency: seconds each request is delayed
+        :param gzip: compress files for clients accepting gzip
+        """
+        super().__init__(('127.0.0.1', 0),
+                         functools.partial(_Handler, directory=directory))
+        self.connect_latency = connect_latency
+        self.latency = latency
+        self.gzip = gzip
+        self._lock = threading.Lock()
+        self.counts = dict.fromkeys(('connections', 'requests', 'bytes'), 0)
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] += n
+
+
+def make_tree(directory, packages, modules, size):
+    """Write packages of modules of about size bytes to directory.
+
+    :return: names of the packages
+    """
+    names = []
+    for p in range(packages):
+        name = 'benchpkg%d' % p
+        os.makedirs(os.path.join(directory, name))
+        imports = ''.join('from . import mod%d\n' % m for m in range(modules))
+        with open(os.path.join(directory, name, '__init__.py'), 'w') as f:
+            f.write(imports)
+        for m in range(modules):
+            lines, length = [], 0
+            while length < size:
+                line = 'VALUE_%d = %r\n' % (len(lines), 'x' * 40)
+                lines.append(line)
+                length += len(line)
+            with open(os.path.join(directory, name, 'mod%d.py' % m),
+                      'w') as f:
+                f.write(''.join(lines))
+        names.append(name)
+    return names
+
+
+def _import_tree(url, packages, pool, max_connections, prefetch, result):
+    """Import packages from url, and report the time it took."""
+    if pool:
+        urlimport.install_pool(max_connections, gzip=pool == 'pool+gzip')
+    else:
+        urlimport.remove_pool()
+    urlimport.install_meta(url)
+    start = time.perf_counter()
+    if prefetch:
+        urlimport.prefetch(url, workers=max_connections)
+    for name in packages:
+        __import__(name)
+    result.send(time.perf_counter() - start)
+
+
+def bench_import(server, packages, pool, max_connections, prefetch):
+    """Import packages from server in a new process.
+
+    :param pool: None to fetch with urlopen(), 'pool' or 'pool+gzip'
+    :return: dict of the time taken and what the server counted
+    """
+    counts = dict(server.counts)
+    receiver, sender = mp.Pipe(duplex=False)
+    importer = mp.Process(target=_import_tree, args=(
+        server.url, packages, pool, max_connections, prefetch, sender))
+    importer.start()
+    elapsed = receiver.recv()
+    importer.join()
+    result = {name: server.counts[name] - counts[name] for name in counts}
+    result['elapsed_ms'] = elapsed * 1e3
+    return result
+
+
+def run_import_suite(args, tmp_dir):
+    """Benchmark importing a remote tree, printing and returning results."""
+    packages = make_tree(tmp_dir, args.packages, args.modules, args.size)
+    server = TestServer(tmp_dir, args.connect_latency / 1e3,
+                        args.latency / 1e3)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    results = []
+    try:
+        for prefetch in (False, True):
+            for pool in (None, 'pool', 'pool+gzip'):
+                for max_connections in args.max_connections:
+                    # Without prefetching, imports fetch one at a time.
+                    if not prefetch and max_connections != \
+                            args.max_connections[0]:
+                        continue
+                    result = bench_import(server, packages, pool,
+                                          max_connections, prefetch)
+                    result.update(pool=pool or 'urlopen', prefetch=prefetch,
+                                  max_connections=max_connections,
+                                  modules=args.packages * (args.modules + 1))
+                    results.append(result)
+                    print('%-9s %-9s max_connections=%-3d %9.1f ms  '
+                          'requests=%-5d connections=%-5d bytes=%d'
+                          % (result['pool'],
+                             'prefetch' if prefetch else 'import',
+                             max_connections, result['elapsed_ms'],
+                             result['requests'], result['connections'],
+                             result['bytes']))
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--packages', type=int, default=4)
+    parser.add_argument('--modules', type=int, default=25,
+                        help='modules per package')
+    parser.add_argument('--size', type=int, default=4096,
+                        help='bytes of source per module')
+    parser.add_argument('--connect-latency', type=float, default=20.0,
+                        help='ms each new connection is delayed')
+    parser.add_argument('--latency', type=float, default=1.0,
+                        help='ms each request is delayed')
+    parser.add_argument('--max-connections', type=int, nargs='+',
+                        default=[4])
+    parser.add_argument('--json', metavar='PATH',
+                        help='also write the results to PATH as JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = run_import_suite(args, tmp_dir)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'suite': 'import', 'time': time.time(),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'results': results}, f, indent=2)